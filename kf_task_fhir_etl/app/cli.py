@@ -1,9 +1,21 @@
 """
 Entry point for the Kids First FHIR ETL Task Service Client
+
+Only click and kf_task_fhir_etl.config are imported up front. The ETL and its
+heavy dependencies (pandas, SQLAlchemy, kf_lib_data_ingest) are imported when
+a command runs, so that printing help or the version is fast.
 """
 import click
 
-from kf_task_fhir_etl.etl.ingest import Ingest
+from kf_task_fhir_etl.config import (
+    BUNDLE_TYPES,
+    GENOMIC_FILE_CACHE_TTL,
+    HTTP_POOL_SIZE,
+    HTTP_TIMEOUT,
+    ID_STRATEGIES,
+    LOAD_MODES,
+    TRANSFORM_MODES,
+)
 
 CONTEXT_SETTINGS = {"help_option_names": ["-h", "--help"]}
 
@@ -16,7 +28,275 @@ def cli():
 
 @click.command()
 @click.argument("kf_study_ids", required=True, nargs=-1)
-def fhir_etl(kf_study_ids):
+@click.option(
+    "--transform-mode",
+    type=click.Choice(TRANSFORM_MODES),
+    default="merged",
+    show_default=True,
+    help="Outer-merge all tables into one, or build one table per target class",
+)
+@click.option(
+    "--http-pool-size",
+    type=click.IntRange(min=1),
+    default=HTTP_POOL_SIZE,
+    show_default=True,
+    help="Number of HTTP connections to keep alive per host",
+)
+@click.option(
+    "--http-pool-block/--no-http-pool-block",
+    default=True,
+    show_default=True,
+    help="Cap HTTP connections per host at the pool size",
+)
+@click.option(
+    "--http-keep-alive/--no-http-keep-alive",
+    default=True,
+    show_default=True,
+    help="Keep HTTP connections alive between requests",
+)
+@click.option(
+    "--http-timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    default=HTTP_TIMEOUT,
+    show_default=True,
+    help="Seconds to wait for an HTTP connection or response",
+)
+@click.option(
+    "--prefetch/--no-prefetch",
+    default=False,
+    show_default=True,
+    help="Index a study's existing FHIR resources before loading it",
+)
+@click.option(
+    "--bundle-type",
+    type=click.Choice(BUNDLE_TYPES),
+    default=None,
+    help="Submit resources in FHIR Bundles of this type instead of one by one",
+)
+@click.option(
+    "--bundle-max-entries",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+    help="Maximum number of resources per Bundle",
+)
+@click.option(
+    "--bundle-max-bytes",
+    type=click.IntRange(min=1),
+    default=5 * 1024 * 1024,
+    show_default=True,
+    help="Maximum payload size of a Bundle in bytes",
+)
+@click.option(
+    "--id-strategy",
+    type=click.Choice(ID_STRATEGIES),
+    default="server",
+    show_default=True,
+    help="Let the FHIR server assign IDs, or derive them from KF IDs",
+)
+@click.option(
+    "--dataservice-workers",
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Number of concurrent workers prefetching genomic file metadata",
+)
+@click.option(
+    "--genomic-file-cache",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Path to a SQLite cache of genomic file metadata kept between runs",
+)
+@click.option(
+    "--genomic-file-cache-ttl",
+    type=click.FloatRange(min=0),
+    default=GENOMIC_FILE_CACHE_TTL,
+    show_default=True,
+    help="Seconds before cached genomic file metadata is revalidated",
+)
+@click.option(
+    "--db-pool-size",
+    type=click.IntRange(min=1),
+    default=5,
+    show_default=True,
+    help="Number of KF Dataservice DB connections to pool",
+)
+@click.option(
+    "--extract-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of studies to extract from the KF Dataservice DB concurrently",
+)
+@click.option(
+    "--snapshot-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory to save each study's extracted tables to as Parquet",
+)
+@click.option(
+    "--from-snapshot",
+    is_flag=True,
+    default=False,
+    help="Read extracted tables back from --snapshot-dir instead of the DB",
+)
+@click.option(
+    "--state-db",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Path to a SQLite DB of per-study ingest state kept between runs",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only load rows modified since a study's last load in --state-db",
+)
+@click.option(
+    "--skip-unchanged",
+    is_flag=True,
+    default=False,
+    help="Skip studies unchanged since their last load in --state-db",
+)
+@click.option(
+    "--entity-ledger",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Path to a SQLite ledger of submitted entities, to skip unchanged ones",
+)
+@click.option(
+    "--async-submit/--no-async-submit",
+    default=False,
+    show_default=True,
+    help="Submit resources over an asyncio HTTP client instead of requests",
+)
+@click.option(
+    "--max-in-flight",
+    type=click.IntRange(min=1),
+    default=64,
+    show_default=True,
+    help="Maximum number of asyncio submit requests in flight",
+)
+@click.option(
+    "--max-in-flight-per-target",
+    type=click.IntRange(min=1),
+    default=32,
+    show_default=True,
+    help="Maximum number of asyncio submit requests in flight per resource type",
+)
+@click.option(
+    "--adaptive-concurrency/--no-adaptive-concurrency",
+    default=False,
+    show_default=True,
+    help="Adapt the number of FHIR service requests in flight to its latency",
+)
+@click.option(
+    "--min-concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Lowest adaptive limit of FHIR service requests in flight",
+)
+@click.option(
+    "--max-concurrency",
+    type=click.IntRange(min=1),
+    default=128,
+    show_default=True,
+    help="Highest adaptive limit of FHIR service requests in flight",
+)
+@click.option(
+    "--load-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of independent target classes to load concurrently",
+)
+@click.option(
+    "--load-mode",
+    type=click.Choice(LOAD_MODES),
+    default="classes",
+    show_default=True,
+    help="Load one target class at a time, stream records across classes, or "
+    "load each participant's resources in one transaction Bundle",
+)
+@click.option(
+    "--record-workers",
+    type=click.IntRange(min=1),
+    default=32,
+    show_default=True,
+    help="Number of records, or patient Bundles, to load concurrently",
+)
+@click.option(
+    "--lookup-batch-size",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Maximum number of identifiers per batched target ID search",
+)
+@click.option(
+    "--lookup-max-wait",
+    type=click.FloatRange(min=0),
+    default=0.05,
+    show_default=True,
+    help="Seconds a target ID lookup waits for its batch to fill",
+)
+@click.option(
+    "--page-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Resources per page of FHIR searches (defaults to the server's)",
+)
+@click.option(
+    "--page-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of pages of a FHIR search to fetch concurrently",
+)
+@click.option(
+    "--stream-bundles/--no-stream-bundles",
+    default=False,
+    show_default=True,
+    help="Whether to parse FHIR search Bundles incrementally as they arrive",
+)
+def fhir_etl(
+    kf_study_ids,
+    transform_mode,
+    http_pool_size,
+    http_pool_block,
+    http_keep_alive,
+    http_timeout,
+    prefetch,
+    bundle_type,
+    bundle_max_entries,
+    bundle_max_bytes,
+    id_strategy,
+    dataservice_workers,
+    genomic_file_cache,
+    genomic_file_cache_ttl,
+    db_pool_size,
+    extract_workers,
+    snapshot_dir,
+    from_snapshot,
+    state_db,
+    incremental,
+    skip_unchanged,
+    entity_ledger,
+    async_submit,
+    max_in_flight,
+    max_in_flight_per_target,
+    adaptive_concurrency,
+    min_concurrency,
+    max_concurrency,
+    load_workers,
+    load_mode,
+    record_workers,
+    lookup_batch_size,
+    lookup_max_wait,
+    page_size,
+    page_workers,
+    stream_bundles,
+):
     """
     Ingest a Kids First study(ies) into a FHIR server.
 
@@ -25,7 +305,73 @@ def fhir_etl(kf_study_ids):
         \b
         KF_STUDY_IDS - a KF study ID(s) concatenated by whitespace, e.g., SD_BHJXBDQK SD_M3DBXD12
     """
-    ingest = Ingest(kf_study_ids)
+    if from_snapshot and not snapshot_dir:
+        raise click.UsageError("--from-snapshot requires --snapshot-dir")
+    if incremental and not state_db:
+        raise click.UsageError("--incremental requires --state-db")
+    if skip_unchanged and not state_db:
+        raise click.UsageError("--skip-unchanged requires --state-db")
+
+    from kf_task_fhir_etl.common.aio import configure_async
+    from kf_task_fhir_etl.common.bundle import configure_bundles
+    from kf_task_fhir_etl.common.concurrency import configure_concurrency
+    from kf_task_fhir_etl.common.dataservice import configure_genomic_files
+    from kf_task_fhir_etl.common.ids import configure_ids
+    from kf_task_fhir_etl.common.ledger import configure_ledger
+    from kf_task_fhir_etl.common.lookup import configure_lookups
+    from kf_task_fhir_etl.common.session import configure_session
+    from kf_task_fhir_etl.common.utils import configure_paging
+    from kf_task_fhir_etl.etl.ingest import Ingest
+
+    configure_session(
+        pool_size=http_pool_size,
+        pool_block=http_pool_block,
+        keep_alive=http_keep_alive,
+        timeout=http_timeout,
+    )
+    configure_bundles(
+        bundle_type=bundle_type,
+        max_entries=bundle_max_entries,
+        max_bytes=bundle_max_bytes,
+    )
+    configure_async(
+        enabled=async_submit,
+        max_in_flight=max_in_flight,
+        max_in_flight_per_target=max_in_flight_per_target,
+        timeout=http_timeout,
+    )
+    configure_concurrency(
+        adaptive_concurrency,
+        initial=min(max(8, min_concurrency), max_concurrency),
+        minimum=min_concurrency,
+        maximum=max_concurrency,
+    )
+    configure_ids(id_strategy)
+    configure_lookups(batch_size=lookup_batch_size, max_wait=lookup_max_wait)
+    configure_paging(
+        page_size=page_size, workers=page_workers, stream=stream_bundles
+    )
+    configure_ledger(entity_ledger)
+    configure_genomic_files(
+        workers=dataservice_workers,
+        cache_path=genomic_file_cache,
+        cache_ttl=genomic_file_cache_ttl,
+    )
+    ingest = Ingest(
+        kf_study_ids,
+        transform_mode=transform_mode,
+        prefetch=prefetch,
+        db_pool_size=db_pool_size,
+        extract_workers=extract_workers,
+        snapshot_dir=snapshot_dir,
+        from_snapshot=from_snapshot,
+        incremental=incremental,
+        state_path=state_db,
+        skip_unchanged=skip_unchanged,
+        load_workers=load_workers,
+        load_mode=load_mode,
+        record_workers=record_workers,
+    )
     ingest.run()
 
 
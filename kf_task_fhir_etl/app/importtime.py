@@ -0,0 +1,82 @@
+"""
+Checks that the CLI module imports within a time budget, so that short-lived
+`kidsfirst` invocations (e.g. `kidsfirst fhir-etl -h`) stay fast.
+
+Imports the CLI module in a fresh interpreter with `python -X importtime`,
+prints the slowest imports, and exits with status 1 if all of them together
+took longer than the budget:
+
+    python -m kf_task_fhir_etl.app.importtime --budget 0.2
+"""
+import argparse
+import subprocess
+import sys
+
+CLI_MODULE = "kf_task_fhir_etl.app.cli"
+
+# Default budget in seconds
+IMPORT_TIME_BUDGET = 0.2
+
+
+def measure_import_time(module=CLI_MODULE):
+    """Imports a module in a fresh interpreter and times each import.
+
+    :param module: A module name
+    :type module: str
+    :raises RuntimeError: If the module fails to import
+    :return: The total import time in seconds, and a list of (self seconds,
+        cumulative seconds, module name) tuples
+    :rtype: tuple
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if proc.returncode:
+        raise RuntimeError(f"Failed to import {module}:\n{proc.stderr}")
+
+    total, imports = 0.0, []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        name = name.strip()
+        if name == "site":
+            # Everything before this was imported by the interpreter's startup
+            imports = []
+            continue
+        imports.append((int(self_us) / 1e6, int(cumulative_us) / 1e6, name))
+        if name == module:
+            total = int(cumulative_us) / 1e6
+
+    return total, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"Checks that {CLI_MODULE} imports within a time budget"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=IMPORT_TIME_BUDGET,
+        help=f"Import time budget in seconds (default: {IMPORT_TIME_BUDGET})",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of slowest imports to print"
+    )
+    args = parser.parse_args()
+
+    total, imports = measure_import_time()
+    for self_s, cumulative_s, name in sorted(imports, reverse=True)[: args.top]:
+        print(f"{self_s:8.4f}s self {cumulative_s:8.4f}s cumulative  {name}")
+    print(f"Imported {CLI_MODULE} in {total:.3f}s (budget {args.budget:.3f}s)")
+
+    if total > args.budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
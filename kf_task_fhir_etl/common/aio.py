@@ -0,0 +1,278 @@
+"""
+An asyncio HTTP client for submitting resources to the FHIR service.
+
+All requests run as coroutines on one event loop in a background thread, over
+a single aiohttp connection pool. The number of requests in flight is capped
+both globally and per target (FHIR resource type), so that one busy resource
+type can't take all the connections.
+
+Loaders can schedule whole submissions as coroutines with run() and carry on
+without waiting (see StreamingLoader), so that the number of requests in
+flight is bounded by those caps rather than by the number of loader threads.
+LoadStage's threads instead hand each request to the loop with request() and
+wait for its response, which is shaped like requests' responses so that
+callers keep the same error handling.
+
+Like the retrying requests session, connection errors and 500, 502, 503, and
+504 responses are retried with exponential backoff, except for requests sent
+through the adaptive concurrency limiter, which retries statuses itself.
+Every request times out after the configured number of seconds.
+"""
+import asyncio
+import json
+import threading
+
+from requests import RequestException
+from requests.structures import CaseInsensitiveDict
+
+from kf_task_fhir_etl.config import HTTP_TIMEOUT
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+RETRY_STATUSES = {500, 502, 503, 504}
+
+_lock = threading.Lock()
+_client = None
+_settings = {
+    "enabled": False,
+    "max_in_flight": 64,
+    "max_in_flight_per_target": 32,
+    "retries": 10,
+    "backoff_factor": 0.3,
+    "timeout": HTTP_TIMEOUT,
+}
+
+
+def configure_async(
+    enabled=None, max_in_flight=None, max_in_flight_per_target=None, timeout=None
+):
+    """Configures the asyncio submit path. Takes effect on the next
+    get_async_client().
+
+    :param enabled: Whether to submit resources over the asyncio client
+    :type enabled: bool
+    :param max_in_flight: Maximum number of requests in flight
+    :type max_in_flight: int
+    :param max_in_flight_per_target: Maximum number of requests in flight per
+        FHIR resource type
+    :type max_in_flight_per_target: int
+    :param timeout: Seconds to wait for a request's response
+    :type timeout: float
+    """
+    global _client
+
+    with _lock:
+        for key, value in [
+            ("enabled", enabled),
+            ("max_in_flight", max_in_flight),
+            ("max_in_flight_per_target", max_in_flight_per_target),
+            ("timeout", timeout),
+        ]:
+            if value is not None:
+                _settings[key] = value
+        if _settings["enabled"] and aiohttp is None:
+            raise ImportError("The asyncio submit path requires aiohttp")
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def get_async_client():
+    """Returns the process-wide asyncio client, if enabled.
+
+    :return: An asyncio client, or None
+    :rtype: AsyncClient
+    """
+    global _client
+
+    with _lock:
+        if not _settings["enabled"]:
+            return None
+        if _client is None:
+            _client = AsyncClient(
+                max_in_flight=_settings["max_in_flight"],
+                max_in_flight_per_target=_settings["max_in_flight_per_target"],
+                retries=_settings["retries"],
+                backoff_factor=_settings["backoff_factor"],
+                timeout=_settings["timeout"],
+            )
+        return _client
+
+
+class AsyncResponse:
+    """The parts of a requests.Response that the submitters read."""
+
+    def __init__(self, status_code, text, headers):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def __bool__(self):
+        return self.ok
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncClient:
+    """An aiohttp client running on its own event loop thread."""
+
+    def __init__(
+        self,
+        max_in_flight=64,
+        max_in_flight_per_target=32,
+        retries=10,
+        backoff_factor=0.3,
+        timeout=HTTP_TIMEOUT,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_target = max_in_flight_per_target
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self._target_semaphores = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="fhir-async-submit", daemon=True
+        )
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._open(), self._loop).result()
+
+    async def _open(self):
+        # Created on the loop that they are used on
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+
+    async def _close(self):
+        await self._session.close()
+
+    def _target_semaphore(self, target):
+        if target not in self._target_semaphores:
+            self._target_semaphores[target] = asyncio.Semaphore(
+                self.max_in_flight_per_target
+            )
+        return self._target_semaphores[target]
+
+    async def _request(self, method, url, target, retry_statuses=True, **kwargs):
+        async with self._semaphore, self._target_semaphore(target):
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self._session.request(method, url, **kwargs) as resp:
+                        response = AsyncResponse(
+                            resp.status,
+                            await resp.text(),
+                            CaseInsensitiveDict(resp.headers),
+                        )
+                    if (
+                        not retry_statuses
+                        or response.status_code not in RETRY_STATUSES
+                    ):
+                        return response
+                    if attempt == self.retries:
+                        return response
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.retries:
+                        raise RequestException(f"{method} {url} failed: {e}")
+                await asyncio.sleep(self.backoff_factor * (2**attempt))
+
+    def _kwargs(self, headers, auth, json):
+        headers = {
+            key: value for key, value in (headers or {}).items() if value is not None
+        }
+        kwargs = {"headers": headers, "json": json}
+        if auth and auth[0] is not None:
+            kwargs["auth"] = aiohttp.BasicAuth(auth[0], auth[1] or "")
+        return kwargs
+
+    async def send(
+        self,
+        method,
+        url,
+        target,
+        headers=None,
+        auth=None,
+        json=None,
+        retry_statuses=True,
+    ):
+        """Sends a request from a coroutine running on the client's loop.
+
+        :param method: An HTTP method
+        :type method: str
+        :param url: A URL
+        :type url: str
+        :param target: What the request counts against, e.g. "Patient"
+        :type target: str
+        :param headers: HTTP headers; those with a value of None are dropped
+        :type headers: dict
+        :param auth: A (username, password) tuple for basic auth
+        :type auth: tuple
+        :param json: A JSON-serializable body
+        :type json: dict
+        :param retry_statuses: Whether to retry 5xx responses, rather than
+            leaving that to the caller
+        :type retry_statuses: bool
+        :raise: RequestException if the request couldn't be sent
+        :return: The response
+        :rtype: AsyncResponse
+        """
+        return await self._request(
+            method,
+            url,
+            target,
+            retry_statuses=retry_statuses,
+            **self._kwargs(headers, auth, json),
+        )
+
+    def run(self, coro):
+        """Schedules a coroutine on the client's loop from any thread, without
+        waiting for it.
+
+        :param coro: A coroutine
+        :type coro: coroutine
+        :return: A future of the coroutine's result
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def request(
+        self,
+        method,
+        url,
+        target,
+        headers=None,
+        auth=None,
+        json=None,
+        retry_statuses=True,
+    ):
+        """Sends a request from any thread and waits for its response. Takes
+        the same parameters as send.
+
+        :raise: RequestException if the request couldn't be sent
+        :return: The response
+        :rtype: AsyncResponse
+        """
+        return self.run(
+            self.send(
+                method,
+                url,
+                target,
+                headers=headers,
+                auth=auth,
+                json=json,
+                retry_statuses=retry_statuses,
+            )
+        ).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,186 @@
+"""
+Packs resources submitted by concurrent loader threads into FHIR batch or
+transaction Bundles (https://www.hl7.org/fhir/http.html#transaction), so that
+one POST to the FHIR service base writes many resources at once.
+
+Each submitter waits until its entry's Bundle has been sent and then gets
+back the FHIR ID from its entry's response.location. A Bundle is sent once it
+holds max_entries entries or max_bytes of payload, or once a submitter has
+waited max_wait seconds. Since submitters block until then, Bundles can only
+be as large as the number of concurrently loading threads.
+"""
+import concurrent.futures
+import json
+import threading
+
+from requests import RequestException
+
+from kf_task_fhir_etl.common.concurrency import call, get_fhir_session
+from kf_task_fhir_etl.common.utils import FHIR_COOKIE, FHIR_USERNAME, FHIR_PASSWORD
+
+_lock = threading.Lock()
+_settings = {
+    "bundle_type": None,
+    "max_entries": 100,
+    "max_bytes": 5 * 1024 * 1024,
+    "max_wait": 0.1,
+}
+_submitters = {}
+
+
+def configure_bundles(
+    bundle_type=None, max_entries=None, max_bytes=None, max_wait=None
+):
+    """Configures Bundle submission. A bundle_type of None disables it.
+
+    :param bundle_type: "batch", "transaction", or None
+    :type bundle_type: str
+    :param max_entries: Maximum number of entries per Bundle
+    :type max_entries: int
+    :param max_bytes: Maximum payload size of a Bundle in bytes
+    :type max_bytes: int
+    :param max_wait: Maximum seconds an entry waits for its Bundle to fill
+    :type max_wait: float
+    """
+    with _lock:
+        _settings["bundle_type"] = bundle_type
+        for key, value in [
+            ("max_entries", max_entries),
+            ("max_bytes", max_bytes),
+            ("max_wait", max_wait),
+        ]:
+            if value is not None:
+                _settings[key] = value
+        _submitters.clear()
+
+
+def get_bundle_submitter(host):
+    """Returns the Bundle submitter for a FHIR service, if Bundles are enabled.
+
+    :param host: A FHIR service base URL
+    :type host: str
+    :return: A Bundle submitter, or None
+    :rtype: BundleSubmitter
+    """
+    with _lock:
+        if not _settings["bundle_type"]:
+            return None
+        if host not in _submitters:
+            _submitters[host] = BundleSubmitter(host, **_settings)
+        return _submitters[host]
+
+
+def resource_id_from_location(location):
+    """Parses "[base/]Type/id[/_history/vid]" into id."""
+    return location.split("/_history")[0].rstrip("/").split("/")[-1]
+
+
+class BundleSubmitter:
+    def __init__(self, host, bundle_type, max_entries, max_bytes, max_wait):
+        self.host = host
+        self.bundle_type = bundle_type
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_bytes = 0
+
+    def submit(self, api_path, body):
+        """Adds a resource to the next Bundle and waits for its FHIR ID.
+
+        :param api_path: A FHIR resource type (e.g. "Patient")
+        :type api_path: str
+        :param body: A FHIR resource
+        :type body: dict
+        :raise: RequestException on error
+        :return: The FHIR ID that the service says was created or updated
+        :rtype: str
+        """
+        resource_id = body.get("id")
+        if resource_id:
+            request = {"method": "PUT", "url": f"{api_path}/{resource_id}"}
+        else:
+            body = {k: v for k, v in body.items() if k != "id"}
+            request = {"method": "POST", "url": api_path}
+        entry = json.dumps({"resource": body, "request": request})
+        size = len(entry.encode("utf-8"))
+        future = concurrent.futures.Future()
+
+        bundles = []
+        with self._lock:
+            if self._pending and self._pending_bytes + size > self.max_bytes:
+                bundles.append(self._take())
+            self._pending.append((entry, future))
+            self._pending_bytes += size
+            if len(self._pending) >= self.max_entries:
+                bundles.append(self._take())
+        for bundle in bundles:
+            self._send(bundle)
+
+        try:
+            return future.result(timeout=self.max_wait)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                bundle = self._take()
+            if bundle:
+                self._send(bundle)
+            return future.result()
+
+    def _take(self):
+        pending, self._pending, self._pending_bytes = self._pending, [], 0
+        return pending
+
+    def _send(self, pending):
+        headers = {
+            "Content-Type": "application/fhir+json;charset=utf-8",
+            "Cookie": FHIR_COOKIE,
+        }
+        auth = (FHIR_USERNAME, FHIR_PASSWORD)
+        data = "".join(
+            [
+                f'{{"resourceType": "Bundle", "type": "{self.bundle_type}", ',
+                '"entry": [',
+                ", ".join(entry for entry, _ in pending),
+                "]}",
+            ]
+        )
+
+        try:
+            resp = call(
+                lambda: get_fhir_session().post(
+                    self.host.rstrip("/"),
+                    data=data.encode("utf-8"),
+                    headers=headers,
+                    auth=auth,
+                )
+            )
+            if resp.status_code != 200:
+                raise RequestException(
+                    f"Sent a {self.bundle_type} Bundle of {len(pending)} "
+                    f"entries to /:\nGot:\n{resp.text}"
+                )
+            response_entries = resp.json().get("entry", [])
+            if len(response_entries) != len(pending):
+                raise RequestException(
+                    f"Sent a {self.bundle_type} Bundle of {len(pending)} "
+                    f"entries but got {len(response_entries)} back"
+                )
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+
+        for (entry, future), response_entry in zip(pending, response_entries):
+            response = response_entry.get("response", {})
+            status = response.get("status", "")
+            location = response.get("location")
+            if status.split(" ")[0] in {"200", "201"} and location:
+                future.set_result(resource_id_from_location(location))
+            else:
+                future.set_exception(
+                    RequestException(
+                        f"Sent in a {self.bundle_type} Bundle:\n{entry}\n"
+                        f"Got:\n{json.dumps(response)}"
+                    )
+                )
@@ -0,0 +1,274 @@
+"""
+An AIMD (additive increase, multiplicative decrease) controller of the number
+of requests in flight to the FHIR service.
+
+Every submit, lookup, and search request waits for a free slot under the
+current limit. The limit grows by one whenever the p95 latency of the recent
+requests stays within a tolerance of the best p95 seen so far, and is halved
+(at most once per cooldown) on a 429 or 5xx response or on a timeout or
+connection error. A 429 or 503 response with a Retry-After header also holds
+back all new requests until then. 429 and 5xx responses are retried by the
+limiter, after their Retry-After or with exponential backoff, and the sessions
+and clients that send requests through it don't retry them themselves (see
+get_fhir_session), so that it sees every one. Coroutines on the asyncio
+client's loop go through call_async, which waits for a slot without blocking
+the loop. The limit is logged whenever it changes.
+"""
+import asyncio
+import email.utils
+import logging
+import threading
+import time
+from collections import deque
+
+from requests import RequestException
+
+from kf_task_fhir_etl.common.session import get_session
+
+# Statuses that the limiter retries, like the retrying session does
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_lock = threading.Lock()
+_settings = {"limiter": None}
+
+
+def configure_concurrency(enabled, initial=8, minimum=1, maximum=128):
+    """Configures the adaptive concurrency controller.
+
+    :param enabled: Whether to limit requests in flight adaptively
+    :type enabled: bool
+    :param initial: Initial limit of requests in flight
+    :type initial: int
+    :param minimum: Lowest limit of requests in flight
+    :type minimum: int
+    :param maximum: Highest limit of requests in flight
+    :type maximum: int
+    """
+    with _lock:
+        _settings["limiter"] = (
+            AdaptiveLimiter(initial=initial, minimum=minimum, maximum=maximum)
+            if enabled
+            else None
+        )
+
+
+def get_limiter():
+    """Returns the adaptive concurrency controller, if enabled.
+
+    :return: An adaptive limiter, or None
+    :rtype: AdaptiveLimiter
+    """
+    return _settings["limiter"]
+
+
+def get_fhir_session():
+    """Returns the session for FHIR service requests sent through call(). With
+    the limiter enabled, the session leaves 5xx responses and Retry-After to
+    the limiter.
+
+    :return: A retrying requests session with pooled adapters
+    :rtype: d3b_utils.requests_retry.Session
+    """
+    return get_session(retry_statuses=get_limiter() is None)
+
+
+def call(send):
+    """Sends a request under the adaptive concurrency limit, if enabled.
+
+    :param send: A function that sends a request and returns its response
+    :type send: callable
+    :return: The response
+    :rtype: requests.Response
+    """
+    limiter = get_limiter()
+    if limiter is None:
+        return send()
+    return limiter.call(send)
+
+
+async def call_async(send):
+    """Sends a request from a coroutine under the adaptive concurrency limit,
+    if enabled.
+
+    :param send: A function that returns an awaitable of a response
+    :type send: callable
+    :return: The response
+    :rtype: kf_task_fhir_etl.common.aio.AsyncResponse
+    """
+    limiter = get_limiter()
+    if limiter is None:
+        return await send()
+    return await limiter.call_async(send)
+
+
+def _retry_after(resp):
+    """Parses a Retry-After header, given in seconds or as an HTTP date."""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+        return max(retry_at - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """Limits requests in flight, adapting the limit to latency and errors."""
+
+    def __init__(
+        self,
+        initial=8,
+        minimum=1,
+        maximum=128,
+        window=100,
+        tolerance=1.5,
+        cooldown=1.0,
+        max_retries=10,
+        backoff_factor=0.3,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.tolerance = tolerance
+        self.cooldown = cooldown
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._latencies = deque(maxlen=window)
+        self._samples = 0
+        self._best_p95 = None
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    async def _acquire_async(self):
+        # Polls rather than waiting on the condition, which would block the loop
+        while True:
+            with self._condition:
+                pause = self._paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+            await asyncio.sleep(max(pause, 0.01))
+
+    def _release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.minimum), self.maximum)
+        changed = int(limit) != int(self.limit)
+        self.limit = limit
+        if changed:
+            logging.info(
+                f"    🎛️ FHIR service concurrency limit: {int(self.limit)} "
+                f"({reason})"
+            )
+            self._condition.notify_all()
+
+    def _on_success(self, latency):
+        with self._condition:
+            self._latencies.append(latency)
+            self._samples += 1
+            if self._samples % 20 or len(self._latencies) < 20:
+                return
+            latencies = sorted(self._latencies)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            if self._best_p95 is None or p95 < self._best_p95:
+                self._best_p95 = p95
+            if p95 <= self._best_p95 * self.tolerance:
+                self._set_limit(self.limit + 1, f"p95 {p95:.3f}s")
+
+    def _on_failure(self, reason, retry_after=None):
+        with self._condition:
+            now = time.monotonic()
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                self._set_limit(self.limit / 2, reason)
+
+    def _on_response(self, resp, latency, attempt):
+        """Adapts the limit to a response.
+
+        :return: Seconds to wait before retrying the request, or None to
+            return the response
+        :rtype: float
+        """
+        status = resp.status_code
+        if status == 429 or status >= 500:
+            retry_after = _retry_after(resp) if status in {429, 503} else None
+            self._on_failure(f"HTTP {status}", retry_after=retry_after)
+            if status in RETRY_STATUSES and attempt < self.max_retries:
+                # New requests are already held back until the Retry-After
+                return 0.0 if retry_after else self.backoff_factor * (2**attempt)
+        else:
+            self._on_success(latency)
+        return None
+
+    def call(self, send):
+        """Sends a request once a slot is free and adapts the limit to it.
+
+        :param send: A function that sends a request and returns its response
+        :type send: callable
+        :return: The response
+        :rtype: requests.Response
+        """
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            start = time.monotonic()
+            try:
+                resp = send()
+            except RequestException as e:
+                self._on_failure(type(e).__name__)
+                raise
+            finally:
+                self._release()
+
+            delay = self._on_response(resp, time.monotonic() - start, attempt)
+            if delay is None:
+                return resp
+            time.sleep(delay)
+
+    async def call_async(self, send):
+        """Sends a request from a coroutine like call, without blocking the
+        event loop while it waits for a slot or backs off.
+
+        :param send: A function that returns an awaitable of a response
+        :type send: callable
+        :return: The response
+        :rtype: kf_task_fhir_etl.common.aio.AsyncResponse
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_async()
+            start = time.monotonic()
+            try:
+                resp = await send()
+            except RequestException as e:
+                self._on_failure(type(e).__name__)
+                raise
+            finally:
+                self._release()
+
+            delay = self._on_response(resp, time.monotonic() - start, attempt)
+            if delay is None:
+                return resp
+            await asyncio.sleep(delay)
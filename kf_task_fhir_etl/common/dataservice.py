@@ -0,0 +1,300 @@
+"""
+Genomic file metadata from the KF Dataservice API, which merges in the file's
+Indexd record (size, hashes, acl, latest_did, file_name, ...).
+
+The metadata of all genomic files being loaded is prefetched by a bounded
+pool of workers, and then served from memory while the DRSDocumentReference
+entities are built. Each genomic file still takes its own GET, so the
+prefetch overlaps those requests rather than reducing their number. The
+workers take the genomic files in chunks, and write each chunk to the cache
+in one transaction.
+
+Optionally, the metadata is also kept in a persistent SQLite cache between
+runs. Cached metadata younger than the cache's TTL is used as is, and older
+metadata is revalidated with a conditional GET (If-None-Match and
+If-Modified-Since) before being refetched.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import RequestException
+
+from kf_task_fhir_etl.common.session import get_session
+from kf_task_fhir_etl.config import GENOMIC_FILE_CACHE_TTL
+
+# Genomic file fields read by the DRSDocumentReference builder
+GENOMIC_FILE_FIELDS = [
+    "controlled_access",
+    "data_type",
+    "latest_did",
+    "file_format",
+    "acl",
+    "size",
+    "hashes",
+    "file_name",
+]
+
+_settings = {"workers": 16, "chunk_size": 100}
+
+
+def configure_genomic_files(
+    workers=None, chunk_size=None, cache_path=None, cache_ttl=None
+):
+    """Configures genomic file metadata prefetching and caching.
+
+    :param workers: Number of concurrent workers
+    :type workers: int
+    :param chunk_size: Number of genomic files that a worker fetches, one GET
+        each, before caching them together
+    :type chunk_size: int
+    :param cache_path: Path to a persistent SQLite cache, or None for none
+    :type cache_path: str
+    :param cache_ttl: Seconds before cached metadata is revalidated
+    :type cache_ttl: float
+    """
+    if workers is not None:
+        _settings["workers"] = workers
+    if chunk_size is not None:
+        _settings["chunk_size"] = chunk_size
+    if cache_path is not None:
+        genomic_file_store.cache = GenomicFileCache(
+            cache_path,
+            ttl=cache_ttl if cache_ttl is not None else GENOMIC_FILE_CACHE_TTL,
+        )
+
+
+def fetch_genomic_file(base_url, genomic_file_id, etag=None, last_modified=None):
+    """GETs the metadata of a genomic file from the KF Dataservice API.
+
+    :param base_url: A KF Dataservice API base URL
+    :type base_url: str
+    :param genomic_file_id: A genomic file KF ID
+    :type genomic_file_id: str
+    :param etag: ETag of a cached copy to revalidate
+    :type etag: str
+    :param last_modified: Last-Modified of a cached copy to revalidate
+    :type last_modified: str
+    :raise: RequestException on error
+    :return: The genomic file's metadata, or None if the cached copy is still
+        valid, along with the response's ETag and Last-Modified
+    :rtype: tuple
+    """
+    url = f"{base_url.rstrip('/')}/genomic-files/{genomic_file_id}"
+    headers = {"Content-Type": "application/json"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    resp = get_session().get(url, headers=headers)
+    etag = resp.headers.get("ETag", etag)
+    last_modified = resp.headers.get("Last-Modified", last_modified)
+    if resp.status_code == 304:
+        return None, etag, last_modified
+    try:
+        resp.raise_for_status()
+    except:
+        raise RequestException(f"{resp.text}")
+
+    genomic_file = resp.json().get("results")
+
+    return (
+        {field: genomic_file.get(field) for field in GENOMIC_FILE_FIELDS},
+        etag,
+        last_modified,
+    )
+
+
+class GenomicFileCache:
+    """A persistent SQLite cache of genomic file metadata keyed by KF ID."""
+
+    def __init__(self, path, ttl=GENOMIC_FILE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._con:
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS genomic_files ("
+                "kf_id TEXT PRIMARY KEY, metadata TEXT, etag TEXT, "
+                "last_modified TEXT, fetched_at REAL)"
+            )
+
+    def get_many(self, genomic_file_ids):
+        """Reads cached genomic files.
+
+        :param genomic_file_ids: Genomic file KF IDs
+        :type genomic_file_ids: list
+        :return: A mapping of KF IDs to (metadata, etag, last_modified, fresh)
+        :rtype: dict
+        """
+        cached, now = {}, time.time()
+        for i in range(0, len(genomic_file_ids), 500):
+            chunk = genomic_file_ids[i : i + 500]
+            with self._lock:
+                rows = self._con.execute(
+                    "SELECT kf_id, metadata, etag, last_modified, fetched_at "
+                    "FROM genomic_files "
+                    f"WHERE kf_id IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            for kf_id, metadata, etag, last_modified, fetched_at in rows:
+                cached[kf_id] = (
+                    json.loads(metadata),
+                    etag,
+                    last_modified,
+                    now - fetched_at < self.ttl,
+                )
+        return cached
+
+    def put_many(self, rows):
+        """Writes genomic files to the cache.
+
+        :param rows: (KF ID, metadata, etag, last_modified) tuples
+        :type rows: list
+        """
+        now = time.time()
+        with self._lock, self._con:
+            self._con.executemany(
+                "INSERT OR REPLACE INTO genomic_files "
+                "(kf_id, metadata, etag, last_modified, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (kf_id, json.dumps(metadata), etag, last_modified, now)
+                    for kf_id, metadata, etag, last_modified in rows
+                ],
+            )
+
+
+class GenomicFileStore:
+    """An in-memory map of genomic file KF IDs to their metadata."""
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._genomic_files = {}
+        self.stats = {"hits": 0, "revalidated": 0, "fetched": 0}
+
+    def _count(self, outcome, n=1):
+        with self._lock:
+            self.stats[outcome] += n
+
+    def _fetch_chunk(self, base_url, chunk, cached):
+        genomic_files, rows = {}, []
+        for genomic_file_id in chunk:
+            metadata, etag, last_modified, _ = cached.get(
+                genomic_file_id, (None, None, None, False)
+            )
+            try:
+                fetched, etag, last_modified = fetch_genomic_file(
+                    base_url, genomic_file_id, etag=etag, last_modified=last_modified
+                )
+            except RequestException as e:
+                # Left for build_entity to refetch and report
+                logging.warning(f"Failed to prefetch {genomic_file_id}: {e}")
+                continue
+            if fetched is None:
+                self._count("revalidated")
+            else:
+                metadata = fetched
+                self._count("fetched")
+            genomic_files[genomic_file_id] = metadata
+            rows.append((genomic_file_id, metadata, etag, last_modified))
+
+        if self.cache is not None:
+            self.cache.put_many(rows)
+        with self._lock:
+            self._genomic_files.update(genomic_files)
+        return len(genomic_files)
+
+    def prefetch(self, base_url, genomic_file_ids):
+        """Concurrently fetches the metadata of genomic files not yet in memory,
+        with one GET per genomic file.
+
+        :param base_url: A KF Dataservice API base URL
+        :type base_url: str
+        :param genomic_file_ids: Genomic file KF IDs
+        :type genomic_file_ids: iterable
+        :return: The number of genomic files fetched or revalidated
+        :rtype: int
+        """
+        with self._lock:
+            missing = sorted(set(genomic_file_ids) - set(self._genomic_files))
+
+        cached = self.cache.get_many(missing) if self.cache is not None else {}
+        fresh = {
+            genomic_file_id: metadata
+            for genomic_file_id, (metadata, _, _, is_fresh) in cached.items()
+            if is_fresh
+        }
+        if fresh:
+            self._count("hits", len(fresh))
+            with self._lock:
+                self._genomic_files.update(fresh)
+            missing = [
+                genomic_file_id
+                for genomic_file_id in missing
+                if genomic_file_id not in fresh
+            ]
+
+        chunk_size = _settings["chunk_size"]
+        chunks = [
+            missing[i : i + chunk_size] for i in range(0, len(missing), chunk_size)
+        ]
+        if not chunks:
+            return 0
+
+        logging.info(f"    🧬 Prefetching {len(missing)} genomic files")
+        with ThreadPoolExecutor(max_workers=_settings["workers"]) as tpex:
+            fetched = sum(
+                tpex.map(
+                    lambda chunk: self._fetch_chunk(base_url, chunk, cached), chunks
+                )
+            )
+        logging.info(f"    🧬 Prefetched {fetched} genomic files")
+
+        return fetched
+
+    def get(self, base_url, genomic_file_id):
+        """Returns a genomic file's metadata, fetching it if not in memory.
+
+        :param base_url: A KF Dataservice API base URL
+        :type base_url: str
+        :param genomic_file_id: A genomic file KF ID
+        :type genomic_file_id: str
+        :raise: RequestException on error
+        :return: The genomic file's metadata
+        :rtype: dict
+        """
+        with self._lock:
+            genomic_file = self._genomic_files.get(genomic_file_id)
+        if genomic_file is None:
+            genomic_file, etag, last_modified = fetch_genomic_file(
+                base_url, genomic_file_id
+            )
+            self._count("fetched")
+            if self.cache is not None:
+                self.cache.put_many(
+                    [(genomic_file_id, genomic_file, etag, last_modified)]
+                )
+            with self._lock:
+                self._genomic_files[genomic_file_id] = genomic_file
+        return genomic_file
+
+    def hit_rate(self):
+        """Returns the fraction of genomic files served without a full GET."""
+        total = sum(self.stats.values())
+        if not total:
+            return 0.0
+        return (self.stats["hits"] + self.stats["revalidated"]) / total
+
+    def clear(self):
+        with self._lock:
+            self._genomic_files.clear()
+
+
+genomic_file_store = GenomicFileStore()
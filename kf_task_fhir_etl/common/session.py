@@ -0,0 +1,156 @@
+"""
+A process-wide pooled HTTP session shared by the FHIR service and dataservice
+clients, so that connections are kept alive and reused across requests instead
+of paying a fresh TCP+TLS handshake per resource.
+
+Every request times out after a configurable number of seconds. Requests that
+the adaptive concurrency limiter retries itself use a second session of the
+same pools' settings whose adapters don't retry 5xx responses or honor
+Retry-After, so that the limiter sees them as soon as they happen.
+
+Each session keeps pools for up to HTTP_POOL_CONNECTIONS hosts, and drops the
+least recently used one beyond that. The requests and connections of dropped
+pools are still counted by connection_stats.
+"""
+import threading
+
+from d3b_utils.requests_retry import Session
+from requests.adapters import HTTPAdapter
+
+from kf_task_fhir_etl.config import (
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_SIZE,
+    HTTP_TIMEOUT,
+)
+
+_lock = threading.Lock()
+_sessions = {}
+# Counts of the pools that were evicted or closed
+_stats_lock = threading.Lock()
+_disposed = {"requests": 0, "connections": 0}
+_settings = {
+    "pool_connections": HTTP_POOL_CONNECTIONS,
+    "pool_size": HTTP_POOL_SIZE,
+    "pool_block": True,
+    "keep_alive": True,
+    "timeout": HTTP_TIMEOUT,
+}
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """An HTTP adapter that applies a default timeout to every request."""
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = _dispose
+
+
+def _dispose(pool):
+    """Counts a pool's requests and connections before closing it."""
+    with _stats_lock:
+        _disposed["requests"] += pool.num_requests
+        _disposed["connections"] += pool.num_connections
+    pool.close()
+
+
+def configure_session(
+    pool_size=None, pool_block=None, keep_alive=None, timeout=None
+):
+    """Configures the shared sessions. Takes effect on the next get_session().
+
+    :param pool_size: Number of connections to keep alive per host
+    :type pool_size: int
+    :param pool_block: Whether to cap connections per host at pool_size and
+        wait for a free one, rather than opening throwaway connections
+    :type pool_block: bool
+    :param keep_alive: Whether to keep connections alive between requests
+    :type keep_alive: bool
+    :param timeout: Seconds to wait for a connection or a response
+    :type timeout: float
+    """
+    with _lock:
+        for key, value in [
+            ("pool_size", pool_size),
+            ("pool_block", pool_block),
+            ("keep_alive", keep_alive),
+            ("timeout", timeout),
+        ]:
+            if value is not None:
+                _settings[key] = value
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_session(retry_statuses=True):
+    """Returns a process-wide pooled session, creating it on first use.
+
+    :param retry_statuses: Whether the session retries 5xx responses and
+        honors Retry-After, rather than leaving that to the caller
+    :type retry_statuses: bool
+    :return: A retrying requests session with pooled adapters
+    :rtype: d3b_utils.requests_retry.Session
+    """
+    with _lock:
+        if retry_statuses not in _sessions:
+            session = Session()
+            for prefix in ["http://", "https://"]:
+                max_retries = session.get_adapter(prefix).max_retries
+                if not retry_statuses:
+                    max_retries = max_retries.new(
+                        status_forcelist=set(), respect_retry_after_header=False
+                    )
+                session.mount(
+                    prefix,
+                    TimeoutHTTPAdapter(
+                        pool_connections=_settings["pool_connections"],
+                        pool_maxsize=_settings["pool_size"],
+                        pool_block=_settings["pool_block"],
+                        max_retries=max_retries,
+                        timeout=_settings["timeout"],
+                    ),
+                )
+            if not _settings["keep_alive"]:
+                session.headers["Connection"] = "close"
+            _sessions[retry_statuses] = session
+        return _sessions[retry_statuses]
+
+
+def connection_stats():
+    """Counts requests sent and connections opened by the shared sessions,
+    including those of pools that were evicted or closed since.
+
+    :return: A dictionary with "requests", "connections", and "reused" counts
+    :rtype: dict
+    """
+    with _stats_lock:
+        requests, connections = _disposed["requests"], _disposed["connections"]
+
+    with _lock:
+        adapters = {
+            adapter
+            for session in _sessions.values()
+            for adapter in session.adapters.values()
+        }
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                requests += pool.num_requests
+                connections += pool.num_connections
+
+    return {
+        "requests": requests,
+        "connections": connections,
+        "reused": max(requests - connections, 0),
+    }
@@ -0,0 +1,60 @@
+"""
+Incremental parsing of FHIR search Bundles from response streams.
+
+resp.json() holds a whole page of results, and its text, in memory before the
+first entry can be used. A StreamedBundle instead decodes the response body
+with ijson as its entries are iterated, so only one entry is held at a time
+and the first entries are used while the rest of the page is still arriving.
+"""
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Parser events that don't complete a value
+_OPENING_EVENTS = {"start_map", "start_array", "map_key"}
+
+
+class StreamedBundle(dict):
+    """A search Bundle parsed from a streamed response.
+
+    Its "entry" is an iterator that decodes entries from the response as it
+    is iterated. The Bundle's other elements (e.g. "total" and "link") are set
+    as they are parsed, and all of them once its entries are exhausted.
+    """
+
+    def __init__(self, resp):
+        if ijson is None:
+            raise ImportError("Streaming search Bundles requires ijson")
+        super().__init__()
+        self._resp = resp
+        self.entry_count = 0
+        self["entry"] = self._entries()
+
+    def _entries(self):
+        self._resp.raw.decode_content = True
+        key, builder = None, None
+        try:
+            for prefix, event, value in ijson.parse(self._resp.raw, use_float=True):
+                if not prefix:
+                    if event == "map_key":
+                        key = value
+                    continue
+                if prefix == key and event in {"start_array", "end_array"}:
+                    if key == "entry":
+                        continue
+
+                if builder is None:
+                    builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+
+                if key == "entry":
+                    if prefix == "entry.item" and event == "end_map":
+                        self.entry_count += 1
+                        yield builder.value
+                        builder = None
+                elif prefix == key and event not in _OPENING_EVENTS:
+                    self[key] = builder.value
+                    builder = None
+        finally:
+            self._resp.close()
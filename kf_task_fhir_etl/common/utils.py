@@ -1,17 +1,49 @@
-import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 
-from dotenv import find_dotenv, load_dotenv
-from d3b_utils.requests_retry import Session
 from requests import RequestException
 
-DOTENV_PATH = find_dotenv()
-if DOTENV_PATH:
-    load_dotenv(DOTENV_PATH)
+from kf_task_fhir_etl.common.concurrency import call, get_fhir_session
+from kf_task_fhir_etl.common.idset import IdSet
+from kf_task_fhir_etl.common.streaming import StreamedBundle, ijson
+from kf_task_fhir_etl.config import FHIR_COOKIE, FHIR_USERNAME, FHIR_PASSWORD
 
+# Number of search results from which resource IDs are deduplicated with an
+# IdSet, which takes a third of a set's memory but is about 8 times slower
+COMPACT_ID_SET_THRESHOLD = 100000
 
-FHIR_COOKIE = os.getenv("FHIR_COOKIE")
-FHIR_USERNAME = os.getenv("FHIR_USERNAME")
-FHIR_PASSWORD = os.getenv("FHIR_PASSWORD")
+_settings = {"page_size": None, "page_workers": 1, "stream": False}
+
+
+def configure_paging(page_size=None, workers=None, stream=None):
+    """Configures the paging of FHIR searches.
+
+    :param page_size: Resources per page (_count), or None for the server's
+        default
+    :type page_size: int
+    :param workers: Number of pages of a search to fetch concurrently
+    :type workers: int
+    :param stream: Whether to parse search Bundles incrementally as they are
+        received
+    :type stream: bool
+    """
+    _settings["page_size"] = page_size
+    if workers is not None:
+        _settings["page_workers"] = workers
+    if stream is not None:
+        if stream and ijson is None:
+            raise ImportError("Streaming search Bundles requires ijson")
+        _settings["stream"] = stream
+
+
+def get_page_size():
+    """Returns the configured page size of FHIR searches, if any.
+
+    :return: Resources per page, or None
+    :rtype: int
+    """
+    return _settings["page_size"]
 
 
 def not_none(val):
@@ -24,7 +56,137 @@ def drop_none(body):
     return {k: v for k, v in body.items() if v is not None}
 
 
-def yield_resources(host, endpoint, filters, show_progress=False):
+def _search_kwargs():
+    headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
+    auth = None
+
+    if FHIR_COOKIE:
+        headers["Cookie"] = FHIR_COOKIE
+
+    if FHIR_USERNAME and FHIR_PASSWORD:
+        auth = (FHIR_USERNAME, FHIR_PASSWORD)
+
+    return {"headers": headers, "auth": auth}
+
+
+def count_resources(host, endpoint, filters):
+    """Counts the resources matching the filter params without fetching them
+    (_summary=count).
+
+    :param host: A FHIR service base URL (e.g. "http://localhost:8000")
+    :type host: str
+    :param endpoint: A FHIR service endpoint (e.g. "Patient")
+    :type endpoint: str
+    :param filters: dict of filters to winnow results from the FHIR service
+    :type filters: dict
+    :raises Exception: If the FHIR service doesn't return status 200
+    :return: The number of matching resources
+    :rtype: int
+    """
+    url = f"{host.rstrip('/')}/{endpoint.lstrip('/')}"
+    params = {**filters, "_summary": "count"}
+    resp = call(
+        lambda: get_fhir_session().get(url, params=params, **_search_kwargs())
+    )
+
+    if resp.status_code != 200:
+        raise RequestException(resp.text)
+
+    return resp.json()["total"]
+
+
+def _get_bundle(session, url, params, kwargs, stream=False):
+    resp = call(lambda: session.get(url, params=params, stream=stream, **kwargs))
+
+    if resp.status_code != 200:
+        raise RequestException(resp.text)
+
+    if stream:
+        return StreamedBundle(resp)
+    return resp.json()
+
+
+def _entry_count(bundle):
+    if isinstance(bundle, StreamedBundle):
+        return bundle.entry_count
+    return len(bundle.get("entry", []))
+
+
+def _next_link(bundle, host):
+    for link in bundle.get("link", []):
+        if link["relation"] == "next":
+            return link["url"].replace("http://localhost:8000", host)
+    return None
+
+
+def _page_links(link_next, page_size, total):
+    """Derives the links of all of a search's remaining pages from the link to
+    its next page, if the FHIR service pages by offset (_getpagesoffset).
+
+    :return: A list of links, or None if they can't be derived
+    :rtype: list
+    """
+    parts = urlsplit(link_next)
+    query = parse_qs(parts.query, keep_blank_values=True)
+    if "_getpagesoffset" not in query or not isinstance(total, int):
+        return None
+    try:
+        offset = int(query["_getpagesoffset"][0])
+        page_size = int(query.get("_count", [page_size])[0])
+    except ValueError:
+        return None
+    if page_size <= 0:
+        return None
+
+    links = []
+    for page_offset in range(offset, total, page_size):
+        query["_getpagesoffset"] = [str(page_offset)]
+        links.append(urlunsplit(parts._replace(query=urlencode(query, doseq=True))))
+    return links
+
+
+def _yield_bundles(host, url, params, kwargs, workers, stream):
+    """Yields a search's pages in order. Once the first page tells the total,
+    up to twice as many pages as workers are fetched ahead concurrently.
+
+    Streamed pages have to be iterated before the next page is fetched.
+    Pages fetched ahead are held whole in memory, so they are never streamed.
+    """
+    session = get_fhir_session()
+    bundle = _get_bundle(session, url, params, kwargs, stream)
+    yield bundle
+
+    link_next = _next_link(bundle, host)
+    page_links = None
+    if workers > 1 and link_next is not None:
+        page_links = _page_links(link_next, _entry_count(bundle), bundle.get("total"))
+
+    if page_links:
+        with ThreadPoolExecutor(max_workers=workers) as tpex:
+            futures = deque()
+            for link in page_links:
+                futures.append(tpex.submit(_get_bundle, session, link, params, kwargs))
+                if len(futures) >= 2 * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        return
+
+    while link_next is not None:
+        bundle = _get_bundle(session, link_next, params, kwargs, stream)
+        yield bundle
+        link_next = _next_link(bundle, host)
+
+
+def yield_resources(
+    host,
+    endpoint,
+    filters,
+    show_progress=False,
+    page_size=None,
+    elements=None,
+    workers=None,
+):
     """Scrapes the FHIR service for paginated entities matching the filter params.
     Note: It's almost always going to be safer to use this than requests.get
     with search parameters, because you never know when you'll get back more
@@ -37,56 +199,65 @@ def yield_resources(host, endpoint, filters, show_progress=False):
     :param filters: dict of filters to winnow results from the FHIR service
         (e.g. {"name": "Children\'s Hospital of Philadelphia"})
     :type filters: dict
+    :param page_size: Resources per page (_count), defaulting to the
+        configured page size
+    :type page_size: int
+    :param elements: Elements of the resources to return (_elements, e.g.
+        ["id", "identifier"]), or None for whole resources
+    :type elements: list
+    :param workers: Number of pages to fetch concurrently, defaulting to the
+        configured number
+    :type workers: int
     :raises Exception: If the FHIR service doesn't return status 200
     :yields: resources matching the filters
     """
     url = f"{host.rstrip('/')}/{endpoint.lstrip('/')}"
 
     expected = 0
-    link_next = url
     found_resource_ids = set()
 
-    headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
-    auth = None
-
-    if FHIR_COOKIE:
-        headers["Cookie"] = FHIR_COOKIE
-
-    if FHIR_USERNAME and FHIR_PASSWORD:
-        auth = (FHIR_USERNAME, FHIR_PASSWORD)
-
-    session = Session()
-    while link_next is not None:
-        resp = session.get(link_next, params=filters, headers=headers, auth=auth)
+    params = dict(filters)
+    page_size = page_size or get_page_size()
+    if page_size:
+        params["_count"] = page_size
+    if elements:
+        params["_elements"] = ",".join(elements)
 
-        if resp.status_code != 200:
-            raise RequestException(resp.text)
+    workers = workers or _settings["page_workers"]
+    for bundle in _yield_bundles(
+        host, url, params, _search_kwargs(), workers, _settings["stream"]
+    ):
+        for entry in bundle.get("entry", []):
+            found = len(found_resource_ids)
+            found_resource_ids.add(entry["resource"]["id"])
+            if len(found_resource_ids) > found:
+                if show_progress:
+                    print(".", end="", flush=True)
+                yield entry
 
-        bundle = resp.json()
+        # Set once a streamed page's entries have been parsed
         expected = bundle["total"]
-        link_next = None
 
-        for link in bundle.get("link", []):
-            if link["relation"] == "next":
-                link_next = link["url"]
-                link_next = link_next.replace("http://localhost:8000", host)
+        if (
+            isinstance(found_resource_ids, set)
+            and isinstance(expected, int)
+            and expected >= COMPACT_ID_SET_THRESHOLD
+        ):
+            compact_ids = IdSet(capacity=expected)
+            for resource_id in found_resource_ids:
+                compact_ids.add(resource_id)
+            found_resource_ids = compact_ids
 
         if show_progress and not expected:
             print("o", end="", flush=True)
 
-        for entry in bundle.get("entry", []):
-            resource_id = entry["resource"]["id"]
-            if resource_id not in found_resource_ids:
-                found_resource_ids.add(resource_id)
-                if show_progress:
-                    print(".", end="", flush=True)
-                yield entry
-
     found = len(found_resource_ids)
     assert expected == found, f"Found {found} resources but expected {expected}"
 
 
-def yield_resource_ids(host, endpoint, filters, show_progress=False):
+def yield_resource_ids(host, endpoint, filters, show_progress=False, page_size=None):
     """Simple wrapper around yield_resources that yields just the FHIR resource IDs"""
-    for entry in yield_resources(host, endpoint, filters, show_progress):
+    for entry in yield_resources(
+        host, endpoint, filters, show_progress, page_size=page_size, elements=["id"]
+    ):
         yield entry["resource"]["id"]
@@ -1,3 +1,39 @@
+"""
+Settings that the CLI needs before a command runs. This module only imports
+lightweight dependencies, so that `kidsfirst -h` doesn't import pandas,
+SQLAlchemy, or kf_lib_data_ingest.
+
+It also loads the .env file, once, for every module that reads environment
+variables.
+"""
 import os
 
+from dotenv import find_dotenv, load_dotenv
+
+DOTENV_PATH = find_dotenv()
+if DOTENV_PATH:
+    load_dotenv(DOTENV_PATH)
+
 ROOT_DIR = os.path.dirname(__file__)
+
+FHIR_COOKIE = os.getenv("FHIR_COOKIE")
+FHIR_USERNAME = os.getenv("FHIR_USERNAME")
+FHIR_PASSWORD = os.getenv("FHIR_PASSWORD")
+
+# Number of per-host connection pools to keep
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS") or 10)
+# Number of connections to keep alive per host
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE") or 32)
+# Seconds to wait for an HTTP connection or response
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT") or 60)
+
+BUNDLE_TYPES = ["batch", "transaction"]
+
+ID_STRATEGIES = ["server", "deterministic"]
+
+# Default time to live of cached genomic file metadata in seconds
+GENOMIC_FILE_CACHE_TTL = 7 * 24 * 60 * 60
+
+TRANSFORM_MODES = ["merged", "normalized"]
+
+LOAD_MODES = ["classes", "records", "patient-bundles"]
@@ -0,0 +1,45 @@
+"""
+Derives the load order of target classes from their entity builders.
+
+A target class depends on the classes whose FHIR IDs its builder references
+through get_target_id_from_record, e.g. Specimen on Patient. Classes whose
+parents have all been loaded can be loaded concurrently.
+"""
+import ast
+import inspect
+import sys
+import textwrap
+
+
+def _referenced_classes(entity_class):
+    """Finds the classes that a builder passes to get_target_id_from_record."""
+    source = textwrap.dedent(inspect.getsource(entity_class))
+    namespace = vars(sys.modules[entity_class.__module__])
+
+    referenced = set()
+    for node in ast.walk(ast.parse(source)):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == "get_target_id_from_record"
+            and node.args
+            and isinstance(node.args[0], ast.Name)
+            and node.args[0].id != "cls"
+        ):
+            referenced.add(namespace.get(node.args[0].id))
+
+    return referenced - {None, entity_class}
+
+
+def find_dependencies(target_classes):
+    """Maps each target class to the target classes that it depends on.
+
+    :param target_classes: Target entity classes to be loaded
+    :type target_classes: list
+    :return: A dictionary mapping a class to a set of classes
+    :rtype: dict
+    """
+    return {
+        target_class: _referenced_classes(target_class) & set(target_classes)
+        for target_class in target_classes
+    }
@@ -0,0 +1,324 @@
+"""
+Queries a study's descendant tables from the KF Dataservice DB.
+
+These are the tables that the transform stage reads, found the same way as
+kf_utils.dataservice.descendants.find_descendants_by_kfids does with
+ignore_gfs_with_hidden_external_contribs=False, but run over a caller's
+connection pool rather than over new connections per query.
+
+A study's fingerprint is computed from the same tables, so that unchanged
+studies can be skipped without reading them. For incremental extraction, the
+descendants can also be restricted to a set of participants, e.g. those whose
+rows (or whose descendants' rows) were modified since a given time.
+
+Since a gap in these queries (a missing endpoint or join path) would silently
+drop data, run this module to check them against kf_utils on a DB, e.g. a
+fixture copy of the KF Dataservice DB, after changing either of them:
+
+    python -m kf_task_fhir_etl.etl.descendants $KF_DATASERVICE_DB_URL SD_XXXXXXXX
+
+It exits with status 1 if any endpoint's KF IDs differ.
+"""
+import hashlib
+
+from sqlalchemy import bindparam, create_engine, text
+import pandas as pd
+
+STUDY_PARTICIPANTS = "SELECT kf_id FROM participant WHERE study_id = :kf_study_id"
+SELECTED_PARTICIPANTS = (
+    "SELECT kf_id FROM participant WHERE kf_id IN :participant_ids"
+)
+
+
+def _descendants(participants):
+    """Maps a dataservice endpoint to its table and a filter on the rows that
+    descend from the participants selected by the given query.
+    """
+    biospecimens = (
+        f"SELECT kf_id FROM biospecimen WHERE participant_id IN ({participants})"
+    )
+    genomic_files = (
+        "SELECT genomic_file_id FROM biospecimen_genomic_file "
+        f"WHERE biospecimen_id IN ({biospecimens})"
+    )
+    return {
+        "participants": ("participant", f"kf_id IN ({participants})"),
+        "families": (
+            "family",
+            "kf_id IN "
+            f"(SELECT family_id FROM participant WHERE kf_id IN ({participants}))",
+        ),
+        "family-relationships": (
+            "family_relationship",
+            f"participant1_id IN ({participants}) "
+            f"OR participant2_id IN ({participants})",
+        ),
+        "diagnoses": ("diagnosis", f"participant_id IN ({participants})"),
+        "phenotypes": ("phenotype", f"participant_id IN ({participants})"),
+        "outcomes": ("outcome", f"participant_id IN ({participants})"),
+        "biospecimens": ("biospecimen", f"participant_id IN ({participants})"),
+        "biospecimen-diagnoses": (
+            "biospecimen_diagnosis",
+            f"biospecimen_id IN ({biospecimens})",
+        ),
+        "biospecimen-genomic-files": (
+            "biospecimen_genomic_file",
+            f"biospecimen_id IN ({biospecimens})",
+        ),
+        "genomic-files": ("genomic_file", f"kf_id IN ({genomic_files})"),
+        "sequencing-experiment-genomic-files": (
+            "sequencing_experiment_genomic_file",
+            f"genomic_file_id IN ({genomic_files})",
+        ),
+        "sequencing-experiments": (
+            "sequencing_experiment",
+            "kf_id IN (SELECT sequencing_experiment_id "
+            "FROM sequencing_experiment_genomic_file "
+            f"WHERE genomic_file_id IN ({genomic_files}))",
+        ),
+    }
+
+
+# Maps a dataservice endpoint to its table and a filter on a study's rows
+DESCENDANTS = _descendants(STUDY_PARTICIPANTS)
+
+# Finds the participants of a study whose own rows, or whose descendants' rows,
+# were modified after :since
+CHANGED_PARTICIPANTS = f"""
+SELECT kf_id FROM participant
+WHERE study_id = :kf_study_id AND modified_at > :since
+UNION
+SELECT p.kf_id FROM participant p JOIN family f ON f.kf_id = p.family_id
+WHERE p.study_id = :kf_study_id AND f.modified_at > :since
+UNION
+SELECT participant1_id FROM family_relationship
+WHERE participant1_id IN ({STUDY_PARTICIPANTS}) AND modified_at > :since
+UNION
+SELECT participant2_id FROM family_relationship
+WHERE participant2_id IN ({STUDY_PARTICIPANTS}) AND modified_at > :since
+UNION
+SELECT participant_id FROM diagnosis
+WHERE participant_id IN ({STUDY_PARTICIPANTS}) AND modified_at > :since
+UNION
+SELECT participant_id FROM phenotype
+WHERE participant_id IN ({STUDY_PARTICIPANTS}) AND modified_at > :since
+UNION
+SELECT participant_id FROM outcome
+WHERE participant_id IN ({STUDY_PARTICIPANTS}) AND modified_at > :since
+UNION
+SELECT participant_id FROM biospecimen
+WHERE participant_id IN ({STUDY_PARTICIPANTS}) AND modified_at > :since
+UNION
+SELECT b.participant_id FROM biospecimen b
+JOIN biospecimen_diagnosis bd ON bd.biospecimen_id = b.kf_id
+WHERE b.participant_id IN ({STUDY_PARTICIPANTS}) AND bd.modified_at > :since
+UNION
+SELECT b.participant_id FROM biospecimen b
+JOIN biospecimen_genomic_file bg ON bg.biospecimen_id = b.kf_id
+LEFT JOIN genomic_file g ON g.kf_id = bg.genomic_file_id
+LEFT JOIN sequencing_experiment_genomic_file sg ON sg.genomic_file_id = g.kf_id
+LEFT JOIN sequencing_experiment s ON s.kf_id = sg.sequencing_experiment_id
+WHERE b.participant_id IN ({STUDY_PARTICIPANTS}) AND (
+    bg.modified_at > :since
+    OR g.modified_at > :since
+    OR sg.modified_at > :since
+    OR s.modified_at > :since
+)
+"""
+
+# Finds the participants that share a family or a genomic file with the
+# selected participants, whose entities are built from each other's rows
+RELATED_PARTICIPANTS = f"""
+SELECT kf_id FROM participant
+WHERE family_id IN (
+    SELECT family_id FROM participant WHERE kf_id IN ({SELECTED_PARTICIPANTS})
+)
+UNION
+SELECT b.participant_id FROM biospecimen b
+JOIN biospecimen_genomic_file bg ON bg.biospecimen_id = b.kf_id
+WHERE bg.genomic_file_id IN (
+    SELECT bg.genomic_file_id FROM biospecimen_genomic_file bg
+    JOIN biospecimen b ON b.kf_id = bg.biospecimen_id
+    WHERE b.participant_id IN ({SELECTED_PARTICIPANTS})
+)
+"""
+
+
+def _read_sql(con, query, params):
+    statement = text(query)
+    if "participant_ids" in params:
+        statement = statement.bindparams(
+            bindparam("participant_ids", expanding=True)
+        )
+    return pd.read_sql(statement, con, params=params)
+
+
+def find_study_descendants(con, kf_study_id, participant_ids=None):
+    """Reads the rows of a study's descendant tables.
+
+    :param con: A SQLAlchemy engine or connection
+    :type con: sqlalchemy.engine.Connectable
+    :param kf_study_id: A KF study ID
+    :type kf_study_id: str
+    :param participant_ids: If given, only read the rows that descend from
+        these participants
+    :type participant_ids: list
+    :return: A dictionary mapping an endpoint to a data frame, for endpoints
+        with at least one row
+    :rtype: dict
+    """
+    descendants = {}
+
+    if participant_ids is None:
+        tables, params = DESCENDANTS, {"kf_study_id": kf_study_id}
+    elif not participant_ids:
+        return descendants
+    else:
+        tables = _descendants(SELECTED_PARTICIPANTS)
+        params = {"participant_ids": sorted(participant_ids)}
+
+    for endpoint, (table, where) in tables.items():
+        df = _read_sql(con, f"SELECT * FROM {table} WHERE {where}", params)
+        if df.shape[0] > 0:
+            descendants[endpoint] = df
+
+    return descendants
+
+
+def find_changed_participants(con, kf_study_id, since):
+    """Finds the participants whose entities need to be rebuilt because rows
+    that they are built from were modified after the given time.
+
+    :param con: A SQLAlchemy engine or connection
+    :type con: sqlalchemy.engine.Connectable
+    :param kf_study_id: A KF study ID
+    :type kf_study_id: str
+    :param since: A timestamp in ISO 8601 format
+    :type since: str
+    :return: A set of participant KF IDs
+    :rtype: set
+    """
+    changed = set(
+        _read_sql(
+            con, CHANGED_PARTICIPANTS, {"kf_study_id": kf_study_id, "since": since}
+        ).iloc[:, 0]
+    )
+
+    # Add the participants sharing a family or a genomic file, since Group and
+    # DocumentReference resources list all of their participants and specimens
+    participant_ids = changed
+    while participant_ids:
+        related = set(
+            _read_sql(
+                con,
+                RELATED_PARTICIPANTS,
+                {"participant_ids": sorted(participant_ids)},
+            ).iloc[:, 0]
+        )
+        participant_ids = related - changed
+        changed |= related
+
+    return changed
+
+
+def find_study_fingerprint(con, kf_study_id):
+    """Computes a cheap fingerprint of a study's rows, from the row count and
+    the latest modified_at of each of its tables, so that added, updated, and
+    deleted rows all change it.
+
+    :param con: A SQLAlchemy engine or connection
+    :type con: sqlalchemy.engine.Connectable
+    :param kf_study_id: A KF study ID
+    :type kf_study_id: str
+    :return: A SHA-256 hex digest
+    :rtype: str
+    """
+    tables = [
+        ("study", "kf_id = :kf_study_id"),
+        (
+            "investigator",
+            "kf_id IN (SELECT investigator_id FROM study WHERE kf_id = :kf_study_id)",
+        ),
+    ] + list(DESCENDANTS.values())
+    query = " UNION ALL ".join(
+        f"SELECT '{table}' AS name, count(*) AS n, max(modified_at) AS modified_at "
+        f"FROM {table} WHERE {where}"
+        for table, where in tables
+    )
+    rows = con.execute(text(query), kf_study_id=kf_study_id).fetchall()
+
+    digest = hashlib.sha256()
+    for name, n, modified_at in rows:
+        digest.update(f"{name}|{n}|{modified_at}\n".encode())
+    return digest.hexdigest()
+
+
+def compare_with_kf_utils(db_url, kf_study_id):
+    """Compares the KF IDs of a study's descendants found by
+    find_study_descendants with those found by kf_utils.
+
+    :param db_url: A KF Dataservice DB URL
+    :type db_url: str
+    :param kf_study_id: A KF study ID
+    :type kf_study_id: str
+    :return: A dictionary mapping an endpoint to a tuple of the KF IDs that
+        find_study_descendants misses and of those it adds, for endpoints
+        whose KF IDs differ
+    :rtype: dict
+    """
+    from kf_utils.dataservice.descendants import find_descendants_by_kfids
+
+    expected = find_descendants_by_kfids(
+        db_url,
+        "studies",
+        kf_study_id,
+        ignore_gfs_with_hidden_external_contribs=False,
+        kfids_only=True,
+    )
+    engine = create_engine(db_url)
+    try:
+        found = find_study_descendants(engine, kf_study_id)
+    finally:
+        engine.dispose()
+
+    differences = {}
+    for endpoint in (set(expected) | set(DESCENDANTS)) - {"studies"}:
+        expected_ids = set(expected.get(endpoint) or [])
+        found_ids = set(found[endpoint].kf_id) if endpoint in found else set()
+        if expected_ids != found_ids:
+            differences[endpoint] = (
+                sorted(expected_ids - found_ids),
+                sorted(found_ids - expected_ids),
+            )
+    return differences
+
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Checks a study's descendant queries against kf_utils"
+    )
+    parser.add_argument("db_url", help="A KF Dataservice DB URL")
+    parser.add_argument("kf_study_ids", nargs="+", help="KF study IDs")
+    args = parser.parse_args()
+
+    mismatched = False
+    for kf_study_id in args.kf_study_ids:
+        differences = compare_with_kf_utils(args.db_url, kf_study_id)
+        for endpoint, (missing, extra) in sorted(differences.items()):
+            print(
+                f"{kf_study_id} {endpoint}: {len(missing)} missing "
+                f"{missing[:5]}, {len(extra)} extra {extra[:5]}"
+            )
+        if not differences:
+            print(f"{kf_study_id}: all endpoints match kf_utils")
+        mismatched = mismatched or bool(differences)
+
+    if mismatched:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,10 @@
 import logging, os, time
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from dotenv import find_dotenv, load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 import pandas as pd
 
-from kf_utils.dataservice.descendants import *
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from kf_lib_data_ingest.common.pandas_utils import outer_merge
 from kf_task_fhir_etl.target_api_plugins.entity_builders import (
@@ -30,74 +29,447 @@ from kf_task_fhir_etl.target_api_plugins.kf_api_fhir_service import all_targets
 from kf_lib_data_ingest.config import DEFAULT_KEY
 from kf_lib_data_ingest.etl.load.load_v2 import LoadStage
 from kf_task_fhir_etl.config import ROOT_DIR
+from kf_task_fhir_etl.common.dataservice import genomic_file_store
+from kf_task_fhir_etl.common.ledger import get_entity_ledger
+from kf_task_fhir_etl.common.lookup import lookup_cache, target_id_index
+from kf_task_fhir_etl.common.session import connection_stats
+from kf_task_fhir_etl.etl.dependencies import find_dependencies
+from kf_task_fhir_etl.etl.descendants import (
+    find_changed_participants,
+    find_study_descendants,
+    find_study_fingerprint,
+)
+from kf_task_fhir_etl.etl.snapshot import read_snapshot, write_snapshot
+from kf_task_fhir_etl.etl.patient_bundles import (
+    PATIENT_BUNDLE_CLASSES,
+    PatientBundleLoader,
+)
+from kf_task_fhir_etl.etl.state import IngestState
+from kf_task_fhir_etl.etl.stream import StreamingLoader
 from kf_lib_data_ingest.common.misc import clean_up_df
 
 logging.basicConfig(level=logging.INFO)
 
-DOTENV_PATH = find_dotenv()
-if DOTENV_PATH:
-    load_dotenv(DOTENV_PATH)
+# Maps an extracted endpoint's columns to KF concepts
+COLUMN_MAPPINGS = {
+    "studies": {
+        "investigator_id": CONCEPT.INVESTIGATOR.TARGET_SERVICE_ID,
+        "attribution": CONCEPT.STUDY.ATTRIBUTION,
+        "data_access_authority": CONCEPT.STUDY.AUTHORITY,
+        "domain": "STUDY|DOMAIN",
+        "external_id": CONCEPT.STUDY.ID,
+        "kf_id": CONCEPT.STUDY.TARGET_SERVICE_ID,
+        "name": CONCEPT.STUDY.NAME,
+        "program": "STUDY|PROGRAM",
+        "release_status": CONCEPT.STUDY.RELEASE_STATUS,
+        "short_code": "STUDY|SHORT_CODE",
+        "short_name": CONCEPT.STUDY.SHORT_NAME,
+        "version": CONCEPT.STUDY.VERSION,
+        "visible": CONCEPT.STUDY.VISIBLE,
+    },
+    "investigators": {
+        "external_id": CONCEPT.INVESTIGATOR.ID,
+        "institution": CONCEPT.INVESTIGATOR.INSTITUTION,
+        "kf_id": CONCEPT.INVESTIGATOR.TARGET_SERVICE_ID,
+        "name": CONCEPT.INVESTIGATOR.NAME,
+        "visible": CONCEPT.INVESTIGATOR.VISIBLE,
+    },
+    "participants": {
+        "family_id": CONCEPT.FAMILY.TARGET_SERVICE_ID,
+        "study_id": CONCEPT.STUDY.TARGET_SERVICE_ID,
+        "affected_status": CONCEPT.PARTICIPANT.IS_AFFECTED_UNDER_STUDY,
+        "diagnosis_category": CONCEPT.STUDY.CATEGORY,
+        "ethnicity": CONCEPT.PARTICIPANT.ETHNICITY,
+        "external_id": CONCEPT.PARTICIPANT.ID,
+        "gender": CONCEPT.PARTICIPANT.GENDER,
+        "is_proband": CONCEPT.PARTICIPANT.IS_PROBAND,
+        "kf_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+        "race": CONCEPT.PARTICIPANT.RACE,
+        "species": CONCEPT.PARTICIPANT.SPECIES,
+        "visible": CONCEPT.PARTICIPANT.VISIBLE,
+    },
+    "families": {
+        "external_id": CONCEPT.FAMILY.ID,
+        "kf_id": CONCEPT.FAMILY.TARGET_SERVICE_ID,
+        "visible": CONCEPT.FAMILY.VISIBLE,
+    },
+    "family-relationships": {
+        "participant1_id": CONCEPT.FAMILY_RELATIONSHIP.PERSON1.TARGET_SERVICE_ID,
+        "participant2_id": CONCEPT.FAMILY_RELATIONSHIP.PERSON2.TARGET_SERVICE_ID,
+        "external_id": CONCEPT.FAMILY_RELATIONSHIP.ID,
+        "kf_id": CONCEPT.FAMILY_RELATIONSHIP.TARGET_SERVICE_ID,
+        "participant1_to_participant2_relation": CONCEPT.FAMILY_RELATIONSHIP.RELATION_FROM_1_TO_2,
+        "visible": CONCEPT.FAMILY_RELATIONSHIP.VISIBLE,
+    },
+    "diagnoses": {
+        "external_id": CONCEPT.DIAGNOSIS.ID,
+        "source_text_diagnosis": CONCEPT.DIAGNOSIS.NAME,
+        "diagnosis_category": CONCEPT.DIAGNOSIS.CATEGORY,
+        "source_text_tumor_location": CONCEPT.DIAGNOSIS.TUMOR_LOCATION,
+        "age_at_event_days": CONCEPT.DIAGNOSIS.EVENT_AGE_DAYS,
+        "mondo_id_diagnosis": CONCEPT.DIAGNOSIS.MONDO_ID,
+        "icd_id_diagnosis": CONCEPT.DIAGNOSIS.ICD_ID,
+        "uberon_id_tumor_location": CONCEPT.DIAGNOSIS.UBERON_TUMOR_LOCATION_ID,
+        "ncit_id_diagnosis": CONCEPT.DIAGNOSIS.NCIT_ID,
+        "spatial_descriptor": CONCEPT.DIAGNOSIS.SPATIAL_DESCRIPTOR,
+        "participant_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+        "kf_id": CONCEPT.DIAGNOSIS.TARGET_SERVICE_ID,
+        "visible": CONCEPT.DIAGNOSIS.VISIBLE,
+    },
+    "phenotypes": {
+        "external_id": CONCEPT.PHENOTYPE.ID,
+        "source_text_phenotype": CONCEPT.PHENOTYPE.NAME,
+        "hpo_id_phenotype": CONCEPT.PHENOTYPE.HPO_ID,
+        "snomed_id_phenotype": CONCEPT.PHENOTYPE.SNOMED_ID,
+        "observed": CONCEPT.PHENOTYPE.OBSERVED,
+        "age_at_event_days": CONCEPT.PHENOTYPE.EVENT_AGE_DAYS,
+        "participant_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+        "kf_id": CONCEPT.PHENOTYPE.TARGET_SERVICE_ID,
+        "visible": CONCEPT.PHENOTYPE.VISIBLE,
+    },
+    "outcomes": {
+        "participant_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+        "age_at_event_days": CONCEPT.OUTCOME.EVENT_AGE_DAYS,
+        "disease_related": CONCEPT.OUTCOME.DISEASE_RELATED,
+        "external_id": CONCEPT.OUTCOME.ID,
+        "kf_id": CONCEPT.OUTCOME.TARGET_SERVICE_ID,
+        "visible": CONCEPT.OUTCOME.VISIBLE,
+        "vital_status": CONCEPT.OUTCOME.VITAL_STATUS,
+    },
+    "biospecimen-diagnoses": {
+        "biospecimen_id": CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
+        "diagnosis_id": CONCEPT.DIAGNOSIS.TARGET_SERVICE_ID,
+        "external_id": CONCEPT.BIOSPECIMEN_DIAGNOSIS.ID,
+        "kf_id": CONCEPT.BIOSPECIMEN_DIAGNOSIS.TARGET_SERVICE_ID,
+        "visible": CONCEPT.BIOSPECIMEN_DIAGNOSIS.VISIBLE,
+    },
+    "biospecimens": {
+        "participant_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+        "sequencing_center_id": CONCEPT.SEQUENCING.CENTER.TARGET_SERVICE_ID,
+        "age_at_event_days": CONCEPT.BIOSPECIMEN.EVENT_AGE_DAYS,
+        "analyte_type": CONCEPT.BIOSPECIMEN.ANALYTE,
+        "composition": CONCEPT.BIOSPECIMEN.COMPOSITION,
+        "consent_type": CONCEPT.BIOSPECIMEN.CONSENT_SHORT_NAME,
+        "dbgap_consent_code": CONCEPT.BIOSPECIMEN.DBGAP_STYLE_CONSENT_CODE,
+        "external_aliquot_id": CONCEPT.BIOSPECIMEN.ID,
+        "external_sample_id": CONCEPT.BIOSPECIMEN_GROUP.ID,
+        "kf_id": CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
+        "method_of_smaple_procurement": CONCEPT.BIOSPECIMEN.SAMPLE_PROCUREMENT,
+        "ncit_id_anatomical_site": CONCEPT.BIOSPECIMEN.NCIT_ANATOMY_SITE_ID,
+        "ncit_id_tissue_type": CONCEPT.BIOSPECIMEN.NCIT_TISSUE_TYPE_ID,
+        "source_text_anatomical_site": CONCEPT.BIOSPECIMEN.ANATOMY_SITE,
+        "source_text_tissue_type": CONCEPT.BIOSPECIMEN.TISSUE_TYPE,
+        "source_text_tumor_descriptor": CONCEPT.BIOSPECIMEN.TUMOR_DESCRIPTOR,
+        "spatial_descriptor": CONCEPT.BIOSPECIMEN.SPATIAL_DESCRIPTOR,
+        "uberon_id_anatomical_site": CONCEPT.BIOSPECIMEN.UBERON_ANATOMY_SITE_ID,
+        "visible": CONCEPT.BIOSPECIMEN.VISIBLE,
+        "volume_ul": CONCEPT.BIOSPECIMEN.VOLUME_UL,
+    },
+    "biospecimen-genomic-files": {
+        "genomic_file_id": CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
+        "biospecimen_id": CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
+        "kf_id": CONCEPT.BIOSPECIMEN_GENOMIC_FILE.TARGET_SERVICE_ID,
+        "visible": CONCEPT.BIOSPECIMEN_GENOMIC_FILE.VISIBLE,
+        "external_id": CONCEPT.BIOSPECIMEN_GENOMIC_FILE.ID,
+    },
+    "genomic-files": {
+        "latest_did": "GENOMIC_FILE|LATEST_DID",
+        "external_id": CONCEPT.GENOMIC_FILE.ID,
+        "data_type": CONCEPT.GENOMIC_FILE.DATA_TYPE,
+        "file_format": CONCEPT.GENOMIC_FILE.FILE_FORMAT,
+        "is_harmonized": CONCEPT.GENOMIC_FILE.HARMONIZED,
+        "reference_genome": CONCEPT.GENOMIC_FILE.REFERENCE_GENOME,
+        "controlled_access": CONCEPT.GENOMIC_FILE.CONTROLLED_ACCESS,
+        "availability": CONCEPT.GENOMIC_FILE.AVAILABILITY,
+        "kf_id": CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
+        "visible": CONCEPT.GENOMIC_FILE.VISIBLE,
+    },
+    "sequencing-experiment-genomic-files": {
+        "external_id": CONCEPT.SEQUENCING_GENOMIC_FILE.ID,
+        "sequencing_experiment_id": CONCEPT.SEQUENCING.TARGET_SERVICE_ID,
+        "genomic_file_id": CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
+        "kf_id": CONCEPT.SEQUENCING_GENOMIC_FILE.TARGET_SERVICE_ID,
+        "visible": CONCEPT.SEQUENCING_GENOMIC_FILE.VISIBLE,
+    },
+    "sequencing-experiments": {
+        "experiment_strategy": CONCEPT.SEQUENCING.STRATEGY,
+        "external_id": CONCEPT.SEQUENCING.ID,
+        "kf_id": CONCEPT.SEQUENCING.TARGET_SERVICE_ID,
+        "visible": CONCEPT.SEQUENCING.VISIBLE,
+    },
+}
+
+# Target classes built from a study's own row and its investigator's row
+STUDY_TARGETS = [Practitioner, Organization, PractitionerRole, ResearchStudy]
+
+
+def _project(df, columns):
+    """Projects a data frame onto those of the given columns that it has.
+
+    :param df: A data frame
+    :type df: pandas.DataFrame
+    :param columns: A list of column names
+    :type columns: list
+    :return: A de-duplicated data frame of the given columns
+    :rtype: pandas.DataFrame
+    """
+    columns = [column for column in columns if column in df.columns]
+    return df[columns].drop_duplicates()
 
 
 class Ingest:
-    def __init__(self, kf_study_ids):
+    def __init__(
+        self,
+        kf_study_ids,
+        transform_mode="merged",
+        prefetch=False,
+        db_pool_size=5,
+        extract_workers=1,
+        snapshot_dir=None,
+        from_snapshot=False,
+        incremental=False,
+        state_path=None,
+        skip_unchanged=False,
+        load_workers=1,
+        load_mode="classes",
+        record_workers=32,
+    ):
         """A constructor method.
 
         :param kf_study_ids: a list of KF study IDs
         :type kf_study_ids: list
+        :param transform_mode: "merged" to outer-merge all tables into one, or
+            "normalized" to build one narrow table per target class
+        :type transform_mode: str
+        :param prefetch: whether to index a study's existing FHIR resources by
+            identifier before loading it, instead of searching per record
+        :type prefetch: bool
+        :param db_pool_size: number of KF dataservice DB connections to pool
+        :type db_pool_size: int
+        :param extract_workers: number of studies to extract concurrently
+        :type extract_workers: int
+        :param snapshot_dir: a directory to save extracted tables to as Parquet
+        :type snapshot_dir: str
+        :param from_snapshot: whether to read extracted tables back from
+            snapshot_dir instead of the KF dataservice DB
+        :type from_snapshot: bool
+        :param incremental: whether to only extract and load the rows modified
+            since a study's last successful load
+        :type incremental: bool
+        :param state_path: a SQLite DB in which to keep each study's high-water
+            mark between runs
+        :type state_path: str
+        :param skip_unchanged: whether to skip the studies whose fingerprint
+            matches the one recorded after their last successful load
+        :type skip_unchanged: bool
+        :param load_workers: number of target classes to load concurrently,
+            in the order of their references to each other
+        :type load_workers: int
+        :param load_mode: "classes" to load one target class at a time with
+            LoadStage, or "records" to stream records of all target classes,
+            each one as soon as the records it references are loaded, or
+            "patient-bundles" to load each participant's resources in one
+            transaction Bundle
+        :type load_mode: str
+        :param record_workers: number of records, or patient Bundles, to load
+            concurrently in the "records" and "patient-bundles" modes
+        :type record_workers: int
         """
+        if from_snapshot and not snapshot_dir:
+            raise ValueError("from_snapshot requires a snapshot_dir")
+        if incremental and not state_path:
+            raise ValueError("incremental requires a state_path")
+        if skip_unchanged and not state_path:
+            raise ValueError("skip_unchanged requires a state_path")
+
         self.kf_study_ids = kf_study_ids
+        self.transform_mode = transform_mode
+        self.prefetch = prefetch
         self.kf_dataservice_db_url = os.getenv("KF_DATASERVICE_DB_URL")
+        self.db_pool_size = db_pool_size
+        self.extract_workers = extract_workers
+        self.snapshot_dir = snapshot_dir
+        self.from_snapshot = from_snapshot
+        self.incremental = incremental
+        self.skip_unchanged = skip_unchanged
+        self.load_workers = load_workers
+        self.load_mode = load_mode
+        self.record_workers = record_workers
+        self.state = IngestState(state_path) if state_path else None
+        self.watermarks = {}
+        self.fingerprints = {}
+        self.skipped_studies = set()
+        self.unchanged_studies = set()
+        self._engine = None
         self.all_targets = defaultdict()
+        self.failed_studies = {}
+
+    @property
+    def engine(self):
+        """A pooled engine shared by all queries to the KF dataservice DB."""
+        if self._engine is None:
+            self._engine = create_engine(
+                self.kf_dataservice_db_url,
+                pool_size=self.db_pool_size,
+                pool_pre_ping=True,
+            )
+        return self._engine
+
+    def _snapshot_study(self, kf_study_id):
+        """Reads a study's tables from the KF dataservice DB.
+
+        In the incremental mode, once a study has a high-water mark, only the
+        descendants of the participants with rows modified since then are
+        read, along with those of the participants that share a family or a
+        genomic file with them. The study and investigator rows are always
+        read, since the other tables are merged onto them.
+
+        With a state DB, the study's fingerprint is computed before its tables
+        are read, and with skip_unchanged, nothing is read if it matches the
+        fingerprint recorded after the study's last successful load.
+
+        :param kf_study_id: a KF study ID
+        :type kf_study_id: str
+        :return: a dictionary mapping an endpoint to a data frame, or None if
+            the study is unchanged
+        :rtype: dict
+        """
+        con = self.engine
+        since = None
+        if self.incremental:
+            since = self.state.get(kf_study_id, "watermark")
+            # Rows modified while the study is being read are read again next time
+            self.watermarks[kf_study_id] = (
+                con.execute(text("SELECT now()")).scalar().isoformat()
+            )
+
+        if self.state is not None:
+            fingerprint = find_study_fingerprint(con, kf_study_id)
+            if self.skip_unchanged and fingerprint == self.state.get(
+                kf_study_id, "fingerprint"
+            ):
+                self.watermarks.pop(kf_study_id, None)
+                return None
+            self.fingerprints[kf_study_id] = fingerprint
+
+        # study
+        study = pd.read_sql(
+            text("SELECT * FROM study WHERE kf_id = :kf_id"),
+            con,
+            params={"kf_id": kf_study_id},
+        )
+        if not study.shape[0] > 0:
+            raise Exception(f"{kf_study_id} not found")
+
+        # investigator
+        investigator_id = study.investigator_id.tolist()[0]
+        investigator = None
+        if investigator_id:
+            investigator = pd.read_sql(
+                text("SELECT * FROM investigator WHERE kf_id = :kf_id"),
+                con,
+                params={"kf_id": investigator_id},
+            )
+
+        # descendants
+        if since is None:
+            descendants = find_study_descendants(con, kf_study_id)
+        else:
+            participant_ids = find_changed_participants(con, kf_study_id, since)
+            logging.info(
+                f"    🔁 {len(participant_ids)} participants of {kf_study_id} "
+                f"changed since {since}"
+            )
+            descendants = find_study_descendants(
+                con, kf_study_id, participant_ids=participant_ids
+            )
+            study_changed = con.execute(
+                text(
+                    "SELECT EXISTS (SELECT kf_id FROM study "
+                    "WHERE kf_id = :kf_id AND modified_at > :since "
+                    "UNION SELECT kf_id FROM investigator "
+                    "WHERE kf_id = :investigator_id AND modified_at > :since)"
+                ),
+                kf_id=kf_study_id,
+                investigator_id=investigator_id,
+                since=since,
+            ).scalar()
+            if not study_changed:
+                self.unchanged_studies.add(kf_study_id)
+        descendants["studies"] = study
+        if investigator is not None:
+            descendants["investigators"] = investigator
+
+        return descendants
 
     def _create_snapshot(self, kf_study_ids):
         """Creates a study's snapshot from the KF dataservice DB.
 
+        Studies are read concurrently by extract_workers threads. A study that
+        fails to be read is logged and recorded in failed_studies, and the
+        other studies are still returned. An unchanged study is logged and
+        recorded in skipped_studies.
+
         :param kf_study_ids: a list of KF study IDs
         :type kf_study_ids: list
         :return: a snapshot of KF studies
         :rtype: dict
         """
-        con = create_engine(self.kf_dataservice_db_url)
         snapshot = defaultdict()
-        expected, found = len(kf_study_ids), 0
 
-        # Loop over KF study IDs
-        for kf_study_id in self.kf_study_ids:
-            # study
-            study = pd.read_sql(
-                f"SELECT * FROM study WHERE kf_id = '{kf_study_id}'", con
-            )
-            if not study.shape[0] > 0:
-                raise Exception(f"{kf_study_id} not found")
-
-            # investigator
-            investigator_id = study.investigator_id.tolist()[0]
-            investigator = None
-            if investigator_id:
-                investigator = pd.read_sql(
-                    f"SELECT * FROM investigator WHERE kf_id = '{investigator_id}'", con
-                )
+        with ThreadPoolExecutor(max_workers=self.extract_workers) as tpex:
+            futures = {
+                kf_study_id: tpex.submit(self._snapshot_study, kf_study_id)
+                for kf_study_id in kf_study_ids
+            }
+            for kf_study_id, future in futures.items():
+                try:
+                    descendants = future.result()
+                except Exception as e:
+                    logging.exception(f"  ❌ Failed to snapshot {kf_study_id}")
+                    self.failed_studies[kf_study_id] = e
+                    continue
+                if descendants is None:
+                    logging.info(
+                        f"  ⏭️ Skipped {kf_study_id}, unchanged since its last load"
+                    )
+                    self.skipped_studies.add(kf_study_id)
+                    continue
+                # Cache a study in memory
+                snapshot[kf_study_id] = descendants
 
-            # descendants
-            descendants = find_descendants_by_kfids(
-                self.kf_dataservice_db_url,
-                "studies",
-                kf_study_id,
-                ignore_gfs_with_hidden_external_contribs=False,
-                kfids_only=False,
-            )
-            descendants["studies"] = study
-            if investigator is not None:
-                descendants["investigators"] = investigator
+        if not snapshot and not self.skipped_studies:
+            raise Exception(f"Failed to snapshot any of {list(kf_study_ids)}")
 
-            # Cache a study in memory
-            snapshot[kf_study_id] = descendants
-            found += 1
+        return snapshot
 
-        assert expected == found, f"Found {found} study(ies) but expected {expected}"
+    def _read_snapshots(self, kf_study_ids):
+        """Reads studies' extracted tables back from the snapshot directory.
 
-        return snapshot
+        :param kf_study_ids: a list of KF study IDs
+        :type kf_study_ids: list
+        :return: A dictionary mapping an endpoint to records per study
+        :rtype: dict
+        """
+        mapped_df_dict = defaultdict()
+
+        for kf_study_id in kf_study_ids:
+            try:
+                mapped_df_dict[kf_study_id] = read_snapshot(
+                    self.snapshot_dir, kf_study_id
+                )
+            except Exception as e:
+                logging.exception(f"  ❌ Failed to read a snapshot of {kf_study_id}")
+                self.failed_studies[kf_study_id] = e
+                continue
+            for endpoint, df in mapped_df_dict[kf_study_id].items():
+                logging.info(f"    📁 {endpoint} {df.shape}")
+            logging.info(f"  ✅ Read a snapshot of {kf_study_id}")
+
+        if not mapped_df_dict:
+            raise Exception(f"Failed to read any of {list(kf_study_ids)}")
+
+        return mapped_df_dict
 
     def extract(self):
         """Extracts records.
@@ -105,6 +477,9 @@ class Ingest:
         :return: A dictionary mapping an endpoint to records
         :rtype: dict
         """
+        if self.from_snapshot:
+            return self._read_snapshots(self.kf_study_ids)
+
         snapshot = self._create_snapshot(self.kf_study_ids)
         mapped_df_dict = defaultdict()
 
@@ -112,386 +487,595 @@ class Ingest:
             logging.info(f"  ⏳ Extracting {kf_study_id}")
 
             # Loop over descendants
-            for endpoint, records in descendants.items():
-                df = None
-                if endpoint in {"investigators", "studies"}:
-                    df = records
-                else:
-                    df = pd.DataFrame.from_dict(records, orient="index")
+            for endpoint, df in descendants.items():
                 df = df.drop(columns=["uuid", "created_at", "modified_at"])
                 mapped_df_dict.setdefault(kf_study_id, {})[endpoint] = df
                 logging.info(f"    📁 {endpoint} {df.shape}")
 
+            if self.snapshot_dir:
+                write_snapshot(
+                    self.snapshot_dir, kf_study_id, mapped_df_dict[kf_study_id]
+                )
+                logging.info(f"    💾 Saved a snapshot to {self.snapshot_dir}")
+
             logging.info(f"  ✅ Extracted {kf_study_id}")
 
         return mapped_df_dict
 
-    def transform(self, mapped_df_dict):
-        """Transforms records.
+    def _rename(self, study_mapped_df_dict):
+        """Renames the columns of a study's extracted tables to KF concepts.
 
-        :param mapped_df_dict: An output from the above exract stage
-        :type mapped_df_dict: dict
-        :return: A dictionary of outer-merged data frames
+        :param study_mapped_df_dict: A mapping of an endpoint to records
+        :type study_mapped_df_dict: dict
+        :return: A dictionary mapping an endpoint to a renamed data frame
         :rtype: dict
         """
-        merged_df_dict = defaultdict()
+        return {
+            endpoint: df.rename(columns=COLUMN_MAPPINGS[endpoint])
+            for endpoint, df in study_mapped_df_dict.items()
+            if df is not None and endpoint in COLUMN_MAPPINGS
+        }
 
-        for kf_study_id, study_mapped_df_dict in mapped_df_dict.items():
-            logging.info(f"  ⏳ Transforming {kf_study_id}")
-            merged_df_dict.setdefault(kf_study_id, {})
-            study_merged_df, study_all_targets = None, set()
-
-            # studies
-            studies = study_mapped_df_dict.get("studies")
-            if studies is not None:
-                studies = studies.rename(
-                    columns={
-                        "investigator_id": CONCEPT.INVESTIGATOR.TARGET_SERVICE_ID,
-                        "attribution": CONCEPT.STUDY.ATTRIBUTION,
-                        "data_access_authority": CONCEPT.STUDY.AUTHORITY,
-                        "domain": "STUDY|DOMAIN",
-                        "external_id": CONCEPT.STUDY.ID,
-                        "kf_id": CONCEPT.STUDY.TARGET_SERVICE_ID,
-                        "name": CONCEPT.STUDY.NAME,
-                        "program": "STUDY|PROGRAM",
-                        "release_status": CONCEPT.STUDY.RELEASE_STATUS,
-                        "short_code": "STUDY|SHORT_CODE",
-                        "short_name": CONCEPT.STUDY.SHORT_NAME,
-                        "version": CONCEPT.STUDY.VERSION,
-                        "visible": CONCEPT.STUDY.VISIBLE,
-                    }
-                )
-                study_all_targets.add(ResearchStudy)
+    def _find_targets(self, tables):
+        """Finds the target entity classes that a study's tables populate.
+
+        :param tables: A dictionary mapping an endpoint to a renamed data frame
+        :type tables: dict
+        :return: A set of target entity classes
+        :rtype: set
+        """
+        study_all_targets = set()
+
+        if tables.get("studies") is not None:
+            study_all_targets.add(ResearchStudy)
+        if tables.get("investigators") is not None:
+            study_all_targets.update(
+                [
+                    Practitioner,
+                    Organization,
+                    PractitionerRole,
+                ]
+            )
+        if tables.get("participants") is not None:
+            study_all_targets.update(
+                [
+                    Patient,
+                    ProbandStatus,
+                    ResearchSubject,
+                ]
+            )
+        if tables.get("families") is not None:
+            study_all_targets.add(Family)
+        if tables.get("family-relationships") is not None:
+            study_all_targets.add(FamilyRelationship)
+        if tables.get("diagnoses") is not None:
+            study_all_targets.add(Disease)
+        if tables.get("phenotypes") is not None:
+            study_all_targets.add(Phenotype)
+        if tables.get("outcomes") is not None:
+            study_all_targets.add(VitalStatus)
+        if tables.get("biospecimens") is not None:
+            study_all_targets.update(
+                [
+                    SequencingCenter,
+                    Specimen,
+                ]
+            )
+            if tables.get("biospecimen-diagnoses") is not None:
+                study_all_targets.add(Histopathology)
+        if tables.get("genomic-files") is not None:
+            study_all_targets.add(DRSDocumentReference)
+
+        return study_all_targets
+
+    def _merge(self, tables):
+        """Cascades outer merges over a study's tables into a single table.
+
+        :param tables: A dictionary mapping an endpoint to a renamed data frame
+        :type tables: dict
+        :return: A dictionary mapping a target class name to a data frame
+        :rtype: dict
+        """
+        study_df_dict, study_merged_df = {}, None
+
+        # studies
+        studies = tables.get("studies")
+
+        # investigators
+        investigators = tables.get("investigators")
+        if investigators is not None:
+            study_merged_df = outer_merge(
+                studies,
+                investigators,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.INVESTIGATOR.TARGET_SERVICE_ID,
+            )
+
+        # participants
+        participants = tables.get("participants")
+        if participants is not None:
+            study_merged_df = outer_merge(
+                study_merged_df if study_merged_df is not None else studies,
+                participants,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.STUDY.TARGET_SERVICE_ID,
+            )
+
+        # families
+        families = tables.get("families")
+        if families is not None:
+            study_merged_df = outer_merge(
+                study_merged_df,
+                families,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.FAMILY.TARGET_SERVICE_ID,
+            )
+
+        # family-relationships
+        family_relationships = tables.get("family-relationships")
+        if family_relationships is not None:
+            study_df_dict[FamilyRelationship.class_name] = clean_up_df(
+                family_relationships
+            )
+
+        # diagnoses
+        diagnoses = tables.get("diagnoses")
+        if diagnoses is not None:
+            study_merged_df = outer_merge(
+                study_merged_df,
+                diagnoses,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+            )
+
+        # phenotypes
+        phenotypes = tables.get("phenotypes")
+        if phenotypes is not None:
+            study_merged_df = outer_merge(
+                study_merged_df,
+                phenotypes,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+            )
+
+        # outcomes
+        outcomes = tables.get("outcomes")
+        if outcomes is not None:
+            study_merged_df = outer_merge(
+                study_merged_df,
+                outcomes,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+            )
+
+        # biospecimen-diagnoses
+        biospecimen_diagnoses = tables.get("biospecimen-diagnoses")
+        if biospecimen_diagnoses is not None:
+            study_merged_df = outer_merge(
+                study_merged_df,
+                biospecimen_diagnoses,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.DIAGNOSIS.TARGET_SERVICE_ID,
+            )
+
+        # biospecimens
+        biospecimens = tables.get("biospecimens")
+        if biospecimens is not None:
+            on = [CONCEPT.PARTICIPANT.TARGET_SERVICE_ID]
+            if biospecimen_diagnoses is not None:
+                on.append(CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID)
 
-            # investigators
-            investigators = study_mapped_df_dict.get("investigators")
+            study_merged_df = outer_merge(
+                study_merged_df, biospecimens, with_merge_detail_dfs=False, on=on
+            )
+
+        # biospecimen-genomic-files
+        biospecimen_genomic_files = tables.get("biospecimen-genomic-files")
+        if biospecimen_genomic_files is not None:
+            study_merged_df = outer_merge(
+                study_merged_df,
+                biospecimen_genomic_files,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
+            )
+
+        # genomic-files
+        genomic_files = tables.get("genomic-files")
+        if genomic_files is not None:
+            study_merged_df = outer_merge(
+                study_merged_df,
+                genomic_files,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
+            )
+
+        # sequencing-experiment-genomic-files
+        sequencing_experiment_genomic_files = tables.get(
+            "sequencing-experiment-genomic-files"
+        )
+        if sequencing_experiment_genomic_files is not None:
+            study_merged_df = outer_merge(
+                study_merged_df,
+                sequencing_experiment_genomic_files,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
+            )
+
+        # sequencing-experiments
+        sequencing_experiments = tables.get("sequencing-experiments")
+        if (
+            sequencing_experiment_genomic_files is not None
+            and sequencing_experiments is not None
+        ):
+            study_merged_df = outer_merge(
+                study_merged_df,
+                sequencing_experiments,
+                with_merge_detail_dfs=False,
+                on=CONCEPT.SEQUENCING.TARGET_SERVICE_ID,
+            )
+
+        study_df_dict[DEFAULT_KEY] = clean_up_df(
+            study_merged_df if study_merged_df is not None else studies
+        )
+
+        return study_df_dict
+
+    def _normalize(self, tables):
+        """Builds one narrow data frame per target class, joining only the
+        tables that the class's entity builder actually reads.
+
+        :param tables: A dictionary mapping an endpoint to a renamed data frame
+        :type tables: dict
+        :return: A dictionary mapping a target class name to a data frame
+        :rtype: dict
+        """
+        target_df_dict = {}
+
+        def add(df, *target_classes):
+            df = clean_up_df(df)
+            for target_class in target_classes:
+                target_df_dict[target_class.class_name] = df
+
+        # studies and investigators
+        studies = tables.get("studies")
+        investigators = tables.get("investigators")
+        if studies is not None:
             if investigators is not None:
-                investigators = investigators.rename(
-                    columns={
-                        "external_id": CONCEPT.INVESTIGATOR.ID,
-                        "institution": CONCEPT.INVESTIGATOR.INSTITUTION,
-                        "kf_id": CONCEPT.INVESTIGATOR.TARGET_SERVICE_ID,
-                        "name": CONCEPT.INVESTIGATOR.NAME,
-                        "visible": CONCEPT.INVESTIGATOR.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    studies,
+                studies = studies.merge(
                     investigators,
-                    with_merge_detail_dfs=False,
+                    how="left",
                     on=CONCEPT.INVESTIGATOR.TARGET_SERVICE_ID,
                 )
-                study_all_targets.update(
-                    [
-                        Practitioner,
-                        Organization,
-                        PractitionerRole,
-                    ]
-                )
+                add(studies, Practitioner, Organization, PractitionerRole)
+            add(studies, ResearchStudy)
 
-            # participants
-            participants = study_mapped_df_dict.get("participants")
-            if participants is not None:
-                participants = participants.rename(
-                    columns={
-                        "family_id": CONCEPT.FAMILY.TARGET_SERVICE_ID,
-                        "study_id": CONCEPT.STUDY.TARGET_SERVICE_ID,
-                        "affected_status": CONCEPT.PARTICIPANT.IS_AFFECTED_UNDER_STUDY,
-                        "diagnosis_category": CONCEPT.STUDY.CATEGORY,
-                        "ethnicity": CONCEPT.PARTICIPANT.ETHNICITY,
-                        "external_id": CONCEPT.PARTICIPANT.ID,
-                        "gender": CONCEPT.PARTICIPANT.GENDER,
-                        "is_proband": CONCEPT.PARTICIPANT.IS_PROBAND,
-                        "kf_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
-                        "race": CONCEPT.PARTICIPANT.RACE,
-                        "species": CONCEPT.PARTICIPANT.SPECIES,
-                        "visible": CONCEPT.PARTICIPANT.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df if study_merged_df is not None else studies,
+        # participants
+        participants = tables.get("participants")
+        if participants is None:
+            return target_df_dict
+        add(participants, Patient, ProbandStatus, ResearchSubject)
+        participant_keys = _project(
+            participants,
+            [
+                CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+                CONCEPT.STUDY.TARGET_SERVICE_ID,
+            ],
+        )
+
+        # families
+        families = tables.get("families")
+        if families is not None:
+            add(
+                _project(
                     participants,
-                    with_merge_detail_dfs=False,
-                    on=CONCEPT.STUDY.TARGET_SERVICE_ID,
-                )
-                study_all_targets.update(
                     [
-                        Patient,
-                        ProbandStatus,
-                        ResearchSubject,
-                    ]
-                )
+                        CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+                        CONCEPT.STUDY.TARGET_SERVICE_ID,
+                        CONCEPT.FAMILY.TARGET_SERVICE_ID,
+                        CONCEPT.PARTICIPANT.SPECIES,
+                    ],
+                ).merge(families, on=CONCEPT.FAMILY.TARGET_SERVICE_ID),
+                Family,
+            )
 
-            # families
-            families = study_mapped_df_dict.get("families")
-            if families is not None:
-                families = families.rename(
-                    columns={
-                        "external_id": CONCEPT.FAMILY.ID,
-                        "kf_id": CONCEPT.FAMILY.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.FAMILY.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    families,
-                    with_merge_detail_dfs=False,
-                    on=CONCEPT.FAMILY.TARGET_SERVICE_ID,
-                )
-                study_all_targets.add(Family)
-
-            # family-relationships
-            family_relationships = study_mapped_df_dict.get("family-relationships")
-            if family_relationships is not None:
-                family_relationships = family_relationships.rename(
-                    columns={
-                        "participant1_id": CONCEPT.FAMILY_RELATIONSHIP.PERSON1.TARGET_SERVICE_ID,
-                        "participant2_id": CONCEPT.FAMILY_RELATIONSHIP.PERSON2.TARGET_SERVICE_ID,
-                        "external_id": CONCEPT.FAMILY_RELATIONSHIP.ID,
-                        "kf_id": CONCEPT.FAMILY_RELATIONSHIP.TARGET_SERVICE_ID,
-                        "participant1_to_participant2_relation": CONCEPT.FAMILY_RELATIONSHIP.RELATION_FROM_1_TO_2,
-                        "visible": CONCEPT.FAMILY_RELATIONSHIP.VISIBLE,
-                    }
-                )
-                merged_df_dict[kf_study_id]["family_relationship"] = clean_up_df(
-                    family_relationships
-                )
-                study_all_targets.add(FamilyRelationship)
-
-            # diagnoses
-            diagnoses = study_mapped_df_dict.get("diagnoses")
-            if diagnoses is not None:
-                diagnoses = diagnoses.rename(
-                    columns={
-                        "external_id": CONCEPT.DIAGNOSIS.ID,
-                        "source_text_diagnosis": CONCEPT.DIAGNOSIS.NAME,
-                        "diagnosis_category": CONCEPT.DIAGNOSIS.CATEGORY,
-                        "source_text_tumor_location": CONCEPT.DIAGNOSIS.TUMOR_LOCATION,
-                        "age_at_event_days": CONCEPT.DIAGNOSIS.EVENT_AGE_DAYS,
-                        "mondo_id_diagnosis": CONCEPT.DIAGNOSIS.MONDO_ID,
-                        "icd_id_diagnosis": CONCEPT.DIAGNOSIS.ICD_ID,
-                        "uberon_id_tumor_location": CONCEPT.DIAGNOSIS.UBERON_TUMOR_LOCATION_ID,
-                        "ncit_id_diagnosis": CONCEPT.DIAGNOSIS.NCIT_ID,
-                        "spatial_descriptor": CONCEPT.DIAGNOSIS.SPATIAL_DESCRIPTOR,
-                        "participant_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
-                        "kf_id": CONCEPT.DIAGNOSIS.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.DIAGNOSIS.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    diagnoses,
-                    with_merge_detail_dfs=False,
-                    on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
-                )
-                study_all_targets.add(Disease)
-
-            # phenotypes
-            phenotypes = study_mapped_df_dict.get("phenotypes")
-            if phenotypes is not None:
-                phenotypes = phenotypes.rename(
-                    columns={
-                        "external_id": CONCEPT.PHENOTYPE.ID,
-                        "source_text_phenotype": CONCEPT.PHENOTYPE.NAME,
-                        "hpo_id_phenotype": CONCEPT.PHENOTYPE.HPO_ID,
-                        "snomed_id_phenotype": CONCEPT.PHENOTYPE.SNOMED_ID,
-                        "observed": CONCEPT.PHENOTYPE.OBSERVED,
-                        "age_at_event_days": CONCEPT.PHENOTYPE.EVENT_AGE_DAYS,
-                        "participant_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
-                        "kf_id": CONCEPT.PHENOTYPE.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.PHENOTYPE.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    phenotypes,
-                    with_merge_detail_dfs=False,
-                    on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
-                )
-                study_all_targets.add(Phenotype)
-
-            # outcomes
-            outcomes = study_mapped_df_dict.get("outcomes")
-            if outcomes is not None:
-                outcomes = outcomes.rename(
-                    columns={
-                        "participant_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
-                        "age_at_event_days": CONCEPT.OUTCOME.EVENT_AGE_DAYS,
-                        "disease_related": CONCEPT.OUTCOME.DISEASE_RELATED,
-                        "external_id": CONCEPT.OUTCOME.ID,
-                        "kf_id": CONCEPT.OUTCOME.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.OUTCOME.VISIBLE,
-                        "vital_status": CONCEPT.OUTCOME.VITAL_STATUS,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    outcomes,
-                    with_merge_detail_dfs=False,
-                    on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
-                )
-                study_all_targets.add(VitalStatus)
+        # family-relationships
+        family_relationships = tables.get("family-relationships")
+        if family_relationships is not None:
+            add(family_relationships, FamilyRelationship)
 
-            # biospecimen-diagnoses
-            biospecimen_diagnoses = study_mapped_df_dict.get("biospecimen-diagnoses")
-            if biospecimen_diagnoses is not None:
-                biospecimen_diagnoses = biospecimen_diagnoses.rename(
-                    columns={
-                        "biospecimen_id": CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
-                        "diagnosis_id": CONCEPT.DIAGNOSIS.TARGET_SERVICE_ID,
-                        "external_id": CONCEPT.BIOSPECIMEN_DIAGNOSIS.ID,
-                        "kf_id": CONCEPT.BIOSPECIMEN_DIAGNOSIS.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.BIOSPECIMEN_DIAGNOSIS.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    biospecimen_diagnoses,
-                    with_merge_detail_dfs=False,
-                    on=CONCEPT.DIAGNOSIS.TARGET_SERVICE_ID,
-                )
+        # diagnoses
+        diagnoses = tables.get("diagnoses")
+        if diagnoses is not None:
+            add(
+                diagnoses.merge(
+                    _project(
+                        participants,
+                        [
+                            CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+                            CONCEPT.STUDY.TARGET_SERVICE_ID,
+                            CONCEPT.PARTICIPANT.IS_AFFECTED_UNDER_STUDY,
+                        ],
+                    ),
+                    on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+                ),
+                Disease,
+            )
 
-            # biospecimens
-            biospecimens = study_mapped_df_dict.get("biospecimens")
-            if biospecimens is not None:
-                biospecimens = biospecimens.rename(
-                    columns={
-                        "participant_id": CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
-                        "sequencing_center_id": CONCEPT.SEQUENCING.CENTER.TARGET_SERVICE_ID,
-                        "age_at_event_days": CONCEPT.BIOSPECIMEN.EVENT_AGE_DAYS,
-                        "analyte_type": CONCEPT.BIOSPECIMEN.ANALYTE,
-                        "composition": CONCEPT.BIOSPECIMEN.COMPOSITION,
-                        "consent_type": CONCEPT.BIOSPECIMEN.CONSENT_SHORT_NAME,
-                        "dbgap_consent_code": CONCEPT.BIOSPECIMEN.DBGAP_STYLE_CONSENT_CODE,
-                        "external_aliquot_id": CONCEPT.BIOSPECIMEN.ID,
-                        "external_sample_id": CONCEPT.BIOSPECIMEN_GROUP.ID,
-                        "kf_id": CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
-                        "method_of_smaple_procurement": CONCEPT.BIOSPECIMEN.SAMPLE_PROCUREMENT,
-                        "ncit_id_anatomical_site": CONCEPT.BIOSPECIMEN.NCIT_ANATOMY_SITE_ID,
-                        "ncit_id_tissue_type": CONCEPT.BIOSPECIMEN.NCIT_TISSUE_TYPE_ID,
-                        "source_text_anatomical_site": CONCEPT.BIOSPECIMEN.ANATOMY_SITE,
-                        "source_text_tissue_type": CONCEPT.BIOSPECIMEN.TISSUE_TYPE,
-                        "source_text_tumor_descriptor": CONCEPT.BIOSPECIMEN.TUMOR_DESCRIPTOR,
-                        "spatial_descriptor": CONCEPT.BIOSPECIMEN.SPATIAL_DESCRIPTOR,
-                        "uberon_id_anatomical_site": CONCEPT.BIOSPECIMEN.UBERON_ANATOMY_SITE_ID,
-                        "visible": CONCEPT.BIOSPECIMEN.VISIBLE,
-                        "volume_ul": CONCEPT.BIOSPECIMEN.VOLUME_UL,
-                    }
-                )
-                on = [CONCEPT.PARTICIPANT.TARGET_SERVICE_ID]
-                study_all_targets.update(
-                    [
-                        SequencingCenter,
-                        Specimen,
-                    ]
-                )
+        # phenotypes
+        phenotypes = tables.get("phenotypes")
+        if phenotypes is not None:
+            add(
+                phenotypes.merge(
+                    participant_keys, on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID
+                ),
+                Phenotype,
+            )
 
-                if biospecimen_diagnoses is not None:
-                    on.append(CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID)
-                    study_all_targets.add(Histopathology)
+        # outcomes
+        outcomes = tables.get("outcomes")
+        if outcomes is not None:
+            add(
+                outcomes.merge(
+                    participant_keys, on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID
+                ),
+                VitalStatus,
+            )
 
-                study_merged_df = outer_merge(
-                    study_merged_df, biospecimens, with_merge_detail_dfs=False, on=on
-                )
+        # biospecimens
+        biospecimens = tables.get("biospecimens")
+        if biospecimens is None:
+            return target_df_dict
+        biospecimens = biospecimens.merge(
+            participant_keys, on=CONCEPT.PARTICIPANT.TARGET_SERVICE_ID
+        )
+        add(biospecimens, SequencingCenter, Specimen)
+        biospecimen_keys = _project(
+            biospecimens,
+            [
+                CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
+                CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+                CONCEPT.STUDY.TARGET_SERVICE_ID,
+            ],
+        )
 
-            # biospecimen-genomic-files
-            biospecimen_genomic_files = study_mapped_df_dict.get(
-                "biospecimen-genomic-files"
-            )
-            if biospecimen_genomic_files is not None:
-                biospecimen_genomic_files = biospecimen_genomic_files.rename(
-                    columns={
-                        "genomic_file_id": CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
-                        "biospecimen_id": CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
-                        "kf_id": CONCEPT.BIOSPECIMEN_GENOMIC_FILE.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.BIOSPECIMEN_GENOMIC_FILE.VISIBLE,
-                        "external_id": CONCEPT.BIOSPECIMEN_GENOMIC_FILE.ID,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    biospecimen_genomic_files,
-                    with_merge_detail_dfs=False,
+        # biospecimen-diagnoses
+        biospecimen_diagnoses = tables.get("biospecimen-diagnoses")
+        if biospecimen_diagnoses is not None:
+            add(
+                biospecimen_diagnoses.merge(
+                    _project(
+                        biospecimens,
+                        [
+                            CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
+                            CONCEPT.PARTICIPANT.TARGET_SERVICE_ID,
+                            CONCEPT.STUDY.TARGET_SERVICE_ID,
+                            CONCEPT.BIOSPECIMEN.TUMOR_DESCRIPTOR,
+                        ],
+                    ),
                     on=CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
-                )
-
-            # genomic-files
-            genomic_files = study_mapped_df_dict.get("genomic-files")
-            if genomic_files is not None:
-                genomic_files = genomic_files.rename(
-                    columns={
-                        "latest_did": "GENOMIC_FILE|LATEST_DID",
-                        "external_id": CONCEPT.GENOMIC_FILE.ID,
-                        "data_type": CONCEPT.GENOMIC_FILE.DATA_TYPE,
-                        "file_format": CONCEPT.GENOMIC_FILE.FILE_FORMAT,
-                        "is_harmonized": CONCEPT.GENOMIC_FILE.HARMONIZED,
-                        "reference_genome": CONCEPT.GENOMIC_FILE.REFERENCE_GENOME,
-                        "controlled_access": CONCEPT.GENOMIC_FILE.CONTROLLED_ACCESS,
-                        "availability": CONCEPT.GENOMIC_FILE.AVAILABILITY,
-                        "kf_id": CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.GENOMIC_FILE.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    genomic_files,
-                    with_merge_detail_dfs=False,
-                    on=CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
-                )
-                study_all_targets.add(DRSDocumentReference)
+                ),
+                Histopathology,
+            )
 
-            # sequencing-experiment-genomic-files
-            sequencing_experiment_genomic_files = study_mapped_df_dict.get(
-                "sequencing-experiment-genomic-files"
+        # genomic-files
+        genomic_files = tables.get("genomic-files")
+        biospecimen_genomic_files = tables.get("biospecimen-genomic-files")
+        if genomic_files is None or biospecimen_genomic_files is None:
+            return target_df_dict
+        documents = (
+            _project(genomic_files, [CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID])
+            .merge(
+                _project(
+                    biospecimen_genomic_files,
+                    [
+                        CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
+                        CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID,
+                    ],
+                ),
+                on=CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
             )
-            if sequencing_experiment_genomic_files is not None:
-                sequencing_experiment_genomic_files = sequencing_experiment_genomic_files.rename(
-                    columns={
-                        "external_id": CONCEPT.SEQUENCING_GENOMIC_FILE.ID,
-                        "sequencing_experiment_id": CONCEPT.SEQUENCING.TARGET_SERVICE_ID,
-                        "genomic_file_id": CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
-                        "kf_id": CONCEPT.SEQUENCING_GENOMIC_FILE.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.SEQUENCING_GENOMIC_FILE.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    sequencing_experiment_genomic_files,
-                    with_merge_detail_dfs=False,
-                    on=CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
-                )
+            .merge(biospecimen_keys, on=CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID)
+        )
 
-            # sequencing-experiments
-            sequencing_experiments = study_mapped_df_dict.get("sequencing-experiments")
-            if (
-                sequencing_experiment_genomic_files is not None
-                and sequencing_experiments is not None
-            ):
-                sequencing_experiments = sequencing_experiments.rename(
-                    columns={
-                        "experiment_strategy": CONCEPT.SEQUENCING.STRATEGY,
-                        "external_id": CONCEPT.SEQUENCING.ID,
-                        "kf_id": CONCEPT.SEQUENCING.TARGET_SERVICE_ID,
-                        "visible": CONCEPT.SEQUENCING.VISIBLE,
-                    }
-                )
-                study_merged_df = outer_merge(
-                    study_merged_df,
-                    sequencing_experiments,
-                    with_merge_detail_dfs=False,
+        # sequencing-experiments
+        sequencing_experiment_genomic_files = tables.get(
+            "sequencing-experiment-genomic-files"
+        )
+        sequencing_experiments = tables.get("sequencing-experiments")
+        if sequencing_experiment_genomic_files is not None:
+            sequencing_df = _project(
+                sequencing_experiment_genomic_files,
+                [
+                    CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID,
+                    CONCEPT.SEQUENCING.TARGET_SERVICE_ID,
+                ],
+            )
+            if sequencing_experiments is not None:
+                sequencing_df = sequencing_df.merge(
+                    _project(
+                        sequencing_experiments,
+                        [
+                            CONCEPT.SEQUENCING.TARGET_SERVICE_ID,
+                            CONCEPT.SEQUENCING.STRATEGY,
+                        ],
+                    ),
+                    how="left",
                     on=CONCEPT.SEQUENCING.TARGET_SERVICE_ID,
                 )
+            documents = documents.merge(
+                sequencing_df, how="left", on=CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID
+            )
+        add(documents, DRSDocumentReference)
 
-            merged_df_dict[kf_study_id][DEFAULT_KEY] = clean_up_df(study_merged_df)
+        return target_df_dict
 
+    def transform(self, mapped_df_dict):
+        """Transforms records.
+
+        In the "merged" mode, a study's tables are outer-merged into one table
+        shared by all target classes. In the "normalized" mode, each target
+        class gets its own narrow table instead, which avoids the
+        combinatorial row blow-up of the merged table.
+
+        :param mapped_df_dict: An output from the above exract stage
+        :type mapped_df_dict: dict
+        :return: A dictionary of data frames per study
+        :rtype: dict
+        """
+        merged_df_dict = defaultdict()
+
+        for kf_study_id, study_mapped_df_dict in mapped_df_dict.items():
+            logging.info(f"  ⏳ Transforming {kf_study_id}")
+            tables = self._rename(study_mapped_df_dict)
+
+            if self.transform_mode == "normalized":
+                merged_df_dict[kf_study_id] = self._normalize(tables)
+            else:
+                merged_df_dict[kf_study_id] = self._merge(tables)
+
+            study_df_dict = merged_df_dict[kf_study_id]
+            study_all_targets = self._find_targets(tables)
             self.all_targets[kf_study_id] = [
-                target for target in all_targets if target in study_all_targets
+                target
+                for target in all_targets
+                if target in study_all_targets
+                and (DEFAULT_KEY in study_df_dict or target.class_name in study_df_dict)
+                and not (
+                    kf_study_id in self.unchanged_studies and target in STUDY_TARGETS
+                )
             ]
 
+            for key, df in study_df_dict.items():
+                logging.info(f"    📁 {key} {df.shape}")
             logging.info(f"  ✅ Transformed {kf_study_id}")
 
         return merged_df_dict
 
+    def _prefetch(self, target_url, kf_study_id):
+        """Indexes a study's existing FHIR resources by identifier.
+
+        :param target_url: A FHIR service base URL
+        :type target_url: str
+        :param kf_study_id: A KF study ID
+        :type kf_study_id: str
+        """
+        api_paths = {target.api_path for target in self.all_targets[kf_study_id]}
+        for api_path in sorted(api_paths):
+            count = target_id_index.prefetch(target_url, api_path, kf_study_id)
+            logging.info(f"    🔎 Prefetched {count} {api_path} resources")
+
+    def _load_classes(self, target_api_config_path, target_url, kf_study_id, df_dict):
+        """Loads a study's target classes concurrently, starting each class as
+        soon as all of the classes that it references have been loaded.
+
+        Each class is loaded by its own LoadStage with its own ID cache, and
+        finds the IDs of the classes loaded before it in the target ID index.
+
+        :param target_api_config_path: A path to the target API plugin
+        :type target_api_config_path: str
+        :param target_url: A FHIR service base URL
+        :type target_url: str
+        :param kf_study_id: A KF study ID
+        :type kf_study_id: str
+        :param df_dict: A dictionary mapping a target class name to records
+        :type df_dict: dict
+        :raises Exception: If any target class fails to be loaded
+        """
+        dependencies = find_dependencies(self.all_targets[kf_study_id])
+        waiting, running, failed = dict(dependencies), {}, {}
+
+        def load_class(target_class):
+            LoadStage(
+                target_api_config_path,
+                target_url,
+                [target_class.class_name],
+                kf_study_id,
+                cache_dir=os.path.join("./", target_class.class_name),
+                use_async=True,
+            ).run(df_dict)
+
+        with ThreadPoolExecutor(max_workers=self.load_workers) as tpex:
+            while waiting or running:
+                for target_class, parents in list(waiting.items()):
+                    failed_parents = parents & set(failed)
+                    if failed_parents:
+                        failed[target_class] = Exception(
+                            f"Skipped since {[p.class_name for p in failed_parents]} "
+                            "failed"
+                        )
+                        del waiting[target_class]
+                    elif not parents & (set(waiting) | set(running)):
+                        logging.info(f"    ⏳ Loading {target_class.class_name}")
+                        running[tpex.submit(load_class, target_class)] = target_class
+                        del waiting[target_class]
+                if not running:
+                    if waiting:
+                        raise Exception(
+                            f"Cyclic references among {[c.class_name for c in waiting]}"
+                        )
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    target_class = running.pop(future)
+                    try:
+                        future.result()
+                        logging.info(f"    ✅ Loaded {target_class.class_name}")
+                    except Exception as e:
+                        logging.exception(
+                            f"    ❌ Failed to load {target_class.class_name}"
+                        )
+                        failed[target_class] = e
+
+        if failed:
+            raise Exception(
+                f"Failed to load {[c.class_name for c in failed]} of {kf_study_id}"
+            )
+
+    def _load_patient_bundles(
+        self, target_api_config_path, target_url, kf_study_id, df_dict
+    ):
+        """Loads a study's participant-level target classes in one transaction
+        Bundle per participant, between the classes that they reference and
+        the classes that reference them, which are loaded with LoadStage.
+
+        :param target_api_config_path: A path to the target API plugin
+        :type target_api_config_path: str
+        :param target_url: A FHIR service base URL
+        :type target_url: str
+        :param kf_study_id: A KF study ID
+        :type kf_study_id: str
+        :param df_dict: A dictionary mapping a target class name to records
+        :type df_dict: dict
+        """
+        targets = self.all_targets[kf_study_id]
+        dependencies = find_dependencies(targets)
+        bundled = [target for target in targets if target in PATIENT_BUNDLE_CLASSES]
+        after = set()
+        for target in targets:
+            if target not in bundled and dependencies[target] & (
+                set(bundled) | after
+            ):
+                after.add(target)
+
+        def load_stage(classes):
+            if classes:
+                LoadStage(
+                    target_api_config_path,
+                    target_url,
+                    [cls.class_name for cls in classes],
+                    kf_study_id,
+                    cache_dir="./",
+                    use_async=True,
+                ).run(df_dict)
+
+        load_stage([t for t in targets if t not in bundled and t not in after])
+        if bundled:
+            PatientBundleLoader(
+                target_url, kf_study_id, workers=self.record_workers
+            ).run(df_dict, bundled)
+        load_stage([t for t in targets if t in after])
+
     def load(self, merged_df_dict):
         """Loads records.
 
@@ -501,20 +1085,88 @@ class Ingest:
         target_api_config_path = os.path.join(
             ROOT_DIR, "target_api_plugins", "kf_api_fhir_service.py"
         )
+        target_url = os.getenv("KF_API_FHIR_SERVICE_URL")
 
         for kf_study_id in merged_df_dict:
             logging.info(f"  ⏳ Loading {kf_study_id}")
 
-            LoadStage(
-                target_api_config_path,
-                os.getenv("KF_API_FHIR_SERVICE_URL"),
-                [cls.class_name for cls in self.all_targets[kf_study_id]],
-                kf_study_id,
-                cache_dir="./",
-                use_async=True,
-            ).run(merged_df_dict[kf_study_id])
+            if not self.all_targets[kf_study_id]:
+                logging.info(f"  ✅ No changes to load for {kf_study_id}")
+            else:
+                if self.prefetch:
+                    self._prefetch(target_url, kf_study_id)
+
+                if self.load_mode == "patient-bundles":
+                    self._load_patient_bundles(
+                        target_api_config_path,
+                        target_url,
+                        kf_study_id,
+                        merged_df_dict[kf_study_id],
+                    )
+                elif self.load_mode == "records":
+                    StreamingLoader(
+                        target_url,
+                        self.all_targets[kf_study_id],
+                        workers=self.record_workers,
+                    ).run(merged_df_dict[kf_study_id])
+                elif self.load_workers > 1:
+                    self._load_classes(
+                        target_api_config_path,
+                        target_url,
+                        kf_study_id,
+                        merged_df_dict[kf_study_id],
+                    )
+                else:
+                    LoadStage(
+                        target_api_config_path,
+                        target_url,
+                        [cls.class_name for cls in self.all_targets[kf_study_id]],
+                        kf_study_id,
+                        cache_dir="./",
+                        use_async=True,
+                    ).run(merged_df_dict[kf_study_id])
+
+                ledger = get_entity_ledger()
+                if ledger is not None:
+                    for class_name, counts in sorted(ledger.pop_stats().items()):
+                        logging.info(
+                            f"    📒 {class_name}: {counts['submitted']} submitted, "
+                            f"{counts['skipped']} skipped as unchanged"
+                        )
 
-            logging.info(f"  ✅ Loaded {kf_study_id}")
+                logging.info(f"  ✅ Loaded {kf_study_id}")
+
+            if kf_study_id in self.watermarks:
+                self.state.set(
+                    kf_study_id, "watermark", self.watermarks[kf_study_id]
+                )
+                logging.info(
+                    f"    🔖 Set {kf_study_id}'s watermark to "
+                    f"{self.watermarks[kf_study_id]}"
+                )
+            if kf_study_id in self.fingerprints:
+                self.state.set(
+                    kf_study_id, "fingerprint", self.fingerprints[kf_study_id]
+                )
+
+        stats = connection_stats()
+        logging.info(
+            f"  🔌 Sent {stats['requests']} HTTP requests over "
+            f"{stats['connections']} connections ({stats['reused']} reused)"
+        )
+        stats = lookup_cache.stats
+        logging.info(
+            f"  🔎 Target ID lookups: {stats['hits']} hits, "
+            f"{stats['coalesced']} coalesced, {stats['misses']} searched "
+            f"({lookup_cache.hit_rate():.1%} hit rate)"
+        )
+        if genomic_file_store.cache is not None:
+            stats = genomic_file_store.stats
+            logging.info(
+                f"  🧬 Genomic file cache: {stats['hits']} hits, "
+                f"{stats['revalidated']} revalidated, {stats['fetched']} fetched "
+                f"({genomic_file_store.hit_rate():.1%} hit rate)"
+            )
 
     def run(self):
         """Runs an ingest pipeline."""
@@ -537,6 +1189,11 @@ class Ingest:
         h, m = divmod(m, 60)
 
         logging.info(
-            f"✅ Finished ingesting {self.kf_study_ids}; ",
+            f"✅ Finished ingesting {self.kf_study_ids}; "
             f"Time elapsed: {h} hours {m} minutes {s} seconds.",
         )
+
+        if self.failed_studies:
+            for kf_study_id, e in self.failed_studies.items():
+                logging.error(f"❌ Failed to ingest {kf_study_id}: {e}")
+            raise Exception(f"Failed to ingest {list(self.failed_studies)}")
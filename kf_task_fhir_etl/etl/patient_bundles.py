@@ -0,0 +1,280 @@
+"""
+Loads each participant's resources in one FHIR transaction Bundle.
+
+A participant's Patient, ResearchSubject, ProbandStatus, Disease, Phenotype,
+VitalStatus, and Specimen resources are built together. Resources that don't
+exist yet get a urn:uuid: fullUrl and are POSTed, and the other resources of
+the Bundle reference them by that fullUrl, which the FHIR service resolves
+when it writes the Bundle. So a new participant takes no lookups at all, and
+its resources are either all written or none are.
+
+Resources that already exist are PUT in place. They are found in the target ID
+index, which is authoritative for a study whose resources were swept into it
+(--prefetch), or else by query_target_ids.
+"""
+import json
+import logging
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from requests import RequestException
+
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+from kf_task_fhir_etl.common.bundle import resource_id_from_location
+from kf_task_fhir_etl.common.concurrency import call, get_fhir_session
+from kf_task_fhir_etl.common.lookup import target_id_index
+from kf_task_fhir_etl.common.utils import (
+    FHIR_COOKIE,
+    FHIR_PASSWORD,
+    FHIR_USERNAME,
+    drop_none,
+)
+from kf_task_fhir_etl.etl.stream import get_records
+from kf_task_fhir_etl.target_api_plugins.entity_builders import (
+    Patient,
+    ProbandStatus,
+    ResearchSubject,
+    Disease,
+    Phenotype,
+    VitalStatus,
+    Specimen,
+)
+
+# Target classes loaded in patient Bundles, in the order they are built
+PATIENT_BUNDLE_CLASSES = [
+    Patient,
+    ResearchSubject,
+    ProbandStatus,
+    Disease,
+    Phenotype,
+    VitalStatus,
+    Specimen,
+]
+
+URN_UUID = "urn:uuid:"
+
+# Matches a reference to a resource of the Bundle, e.g. "Patient/urn:uuid:..."
+_BUNDLE_REFERENCE = re.compile(r"^[A-Za-z]+/(urn:uuid:[0-9a-f\-]+)$")
+
+
+def _key(key_components):
+    return json.dumps(key_components, sort_keys=True, default=str)
+
+
+def _rewrite_references(value):
+    """Rewrites references to resources of the Bundle to their fullUrls."""
+    if isinstance(value, dict):
+        return {k: _rewrite_references(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_rewrite_references(v) for v in value]
+    if isinstance(value, str):
+        match = _BUNDLE_REFERENCE.match(value)
+        if match:
+            return match.group(1)
+    return value
+
+
+class PatientBundleLoader:
+    """Loads participants' resources in one transaction Bundle each."""
+
+    def __init__(self, host, kf_study_id, workers=8):
+        self.host = host
+        self.kf_study_id = kf_study_id
+        self.workers = workers
+        self.stats = {"bundles": 0, "created": 0, "updated": 0, "failed": 0}
+
+    def _find_target_id(self, entity_class, key_components):
+        """Finds an existing resource's FHIR ID, or None if it is new."""
+        filters = drop_none(key_components)
+        if any(URN_UUID in str(value) for value in filters.values()):
+            # References a resource that is new, so it is new as well
+            return None
+
+        if set(filters) == {"identifier"}:
+            resource_ids = target_id_index.get(
+                self.host, entity_class.api_path, filters["identifier"]
+            )
+            if resource_ids:
+                return resource_ids[0]
+            if target_id_index.is_swept(
+                self.host, entity_class.api_path, self.kf_study_id
+            ):
+                return None
+
+        target_ids = entity_class.query_target_ids(self.host, key_components)
+        if len(target_ids) > 1:
+            raise Exception(
+                f"Found {len(target_ids)} {entity_class.class_name} resources "
+                f"for {key_components}: {target_ids}"
+            )
+        return target_ids[0] if target_ids else None
+
+    def _build(self, records):
+        """Builds the transaction Bundle entries of one participant.
+
+        :param records: A list of (target class, record) tuples
+        :type records: list
+        :return: A list of (target class, Bundle entry) tuples
+        :rtype: list
+        """
+        target_ids, entries, seen = {}, [], set()
+
+        def get_target_id_from_record(entity_class, record):
+            key_components = entity_class.get_key_components(
+                record, get_target_id_from_record
+            )
+            key = (entity_class, _key(key_components))
+            if key not in target_ids:
+                if entity_class in PATIENT_BUNDLE_CLASSES:
+                    target_id = self._find_target_id(entity_class, key_components)
+                    target_ids[key] = target_id or f"{URN_UUID}{uuid.uuid4()}"
+                else:
+                    target_ids[key] = self._find_target_id(
+                        entity_class, key_components
+                    )
+            return target_ids[key]
+
+        for entity_class, record in records:
+            try:
+                key = (
+                    entity_class,
+                    _key(
+                        entity_class.get_key_components(
+                            record, get_target_id_from_record
+                        )
+                    ),
+                )
+            except Exception as e:
+                logging.debug(f"Skipping a {entity_class.class_name} record: {e}")
+                continue
+            if key in seen:
+                continue
+            seen.add(key)
+
+            entity = _rewrite_references(
+                entity_class.build_entity(record, get_target_id_from_record)
+            )
+            resource_id = entity.pop("id", None)
+            if resource_id and not resource_id.startswith(URN_UUID):
+                entity["id"] = resource_id
+                entry = {
+                    "fullUrl": f"{self.host.rstrip('/')}/{entity_class.api_path}/"
+                    f"{resource_id}",
+                    "resource": entity,
+                    "request": {
+                        "method": "PUT",
+                        "url": f"{entity_class.api_path}/{resource_id}",
+                    },
+                }
+            else:
+                entry = {
+                    "fullUrl": resource_id or f"{URN_UUID}{uuid.uuid4()}",
+                    "resource": entity,
+                    "request": {"method": "POST", "url": entity_class.api_path},
+                }
+            entries.append((entity_class, entry))
+
+        return entries
+
+    def _send(self, participant_id, records):
+        entries = self._build(records)
+        if not entries:
+            return
+
+        headers = {
+            "Content-Type": "application/fhir+json;charset=utf-8",
+            "Cookie": FHIR_COOKIE,
+        }
+        auth = (FHIR_USERNAME, FHIR_PASSWORD)
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": [entry for _, entry in entries],
+        }
+        resp = call(
+            lambda: get_fhir_session().post(
+                self.host.rstrip("/"), json=bundle, headers=headers, auth=auth
+            )
+        )
+        if resp.status_code != 200:
+            raise RequestException(
+                f"Sent a transaction Bundle of {len(entries)} entries for "
+                f"{participant_id}:\nGot:\n{resp.text}"
+            )
+        response_entries = resp.json().get("entry", [])
+        if len(response_entries) != len(entries):
+            raise RequestException(
+                f"Sent a transaction Bundle of {len(entries)} entries for "
+                f"{participant_id} but got {len(response_entries)} back"
+            )
+
+        created = 0
+        for (entity_class, entry), response_entry in zip(entries, response_entries):
+            location = response_entry.get("response", {}).get("location")
+            if not location:
+                continue
+            resource_id = resource_id_from_location(location)
+            created += entry["request"]["method"] == "POST"
+            for identifier in entry["resource"].get("identifier", []):
+                value = identifier.get("value")
+                if isinstance(value, str):
+                    target_id_index.add(
+                        self.host, entity_class.api_path, value, resource_id
+                    )
+
+        return created, len(entries) - created
+
+    def run(self, df_dict, target_classes):
+        """Loads a study's participants in one transaction Bundle each.
+
+        :param df_dict: A dictionary mapping a target class name to records
+        :type df_dict: dict
+        :param target_classes: Target entity classes to load in the Bundles
+        :type target_classes: list
+        :raises Exception: If any participant's Bundle fails
+        :return: Counts of Bundles and of created, updated, and failed ones
+        :rtype: dict
+        """
+        participants = {}
+        for entity_class in PATIENT_BUNDLE_CLASSES:
+            if entity_class not in target_classes:
+                continue
+            for record in get_records(entity_class, df_dict):
+                participant_id = record.get(CONCEPT.PARTICIPANT.TARGET_SERVICE_ID)
+                if participant_id is not None:
+                    participants.setdefault(participant_id, []).append(
+                        (entity_class, record)
+                    )
+
+        logging.info(f"    📦 Loading {len(participants)} patient Bundles")
+        failures = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as tpex:
+            futures = {
+                participant_id: tpex.submit(self._send, participant_id, records)
+                for participant_id, records in participants.items()
+            }
+            for participant_id, future in futures.items():
+                try:
+                    counts = future.result()
+                except Exception as e:
+                    logging.exception(f"    ❌ Failed to load {participant_id}")
+                    failures[participant_id] = e
+                    self.stats["failed"] += 1
+                    continue
+                if counts:
+                    self.stats["bundles"] += 1
+                    self.stats["created"] += counts[0]
+                    self.stats["updated"] += counts[1]
+
+        logging.info(
+            f"    📦 Loaded {self.stats['bundles']} patient Bundles "
+            f"({self.stats['created']} resources created, "
+            f"{self.stats['updated']} updated, {self.stats['failed']} failed)"
+        )
+        if failures:
+            raise Exception(
+                f"Failed to load {len(failures)} patient Bundles: "
+                f"{list(failures)[:10]}"
+            )
+        return self.stats
@@ -0,0 +1,76 @@
+"""
+Saves and restores the extracted tables of a study as compressed Parquet
+files, laid out as <snapshot_dir>/<KF study ID>/<endpoint>.parquet, so that a
+retried or benchmarked ingest can skip the KF dataservice DB entirely.
+
+A study's snapshot is written to a temporary directory and then swapped in
+for the previous one, so that a snapshot never mixes tables of two runs, e.g.
+when an endpoint has no rows this time.
+"""
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+PARQUET_SUFFIX = ".parquet"
+
+
+def write_snapshot(snapshot_dir, kf_study_id, study_mapped_df_dict):
+    """Writes a study's extracted tables to Parquet files.
+
+    :param snapshot_dir: A directory of snapshots
+    :type snapshot_dir: str
+    :param kf_study_id: A KF study ID
+    :type kf_study_id: str
+    :param study_mapped_df_dict: A dictionary mapping an endpoint to records
+    :type study_mapped_df_dict: dict
+    """
+    study_dir = os.path.join(snapshot_dir, kf_study_id)
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(prefix=f".{kf_study_id}.", dir=snapshot_dir)
+    try:
+        for endpoint, df in study_mapped_df_dict.items():
+            df.reset_index(drop=True).to_parquet(
+                os.path.join(tmp_dir, f"{endpoint}{PARQUET_SUFFIX}"),
+                compression="snappy",
+                index=False,
+            )
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # A directory can only be renamed over an empty one, so move the previous
+    # snapshot aside first
+    old_dir = None
+    if os.path.isdir(study_dir):
+        old_dir = tempfile.mkdtemp(prefix=f".{kf_study_id}.old.", dir=snapshot_dir)
+        os.replace(study_dir, old_dir)
+    os.replace(tmp_dir, study_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def read_snapshot(snapshot_dir, kf_study_id):
+    """Reads a study's extracted tables back from Parquet files.
+
+    :param snapshot_dir: A directory of snapshots
+    :type snapshot_dir: str
+    :param kf_study_id: A KF study ID
+    :type kf_study_id: str
+    :raises FileNotFoundError: If the study has no snapshot
+    :return: A dictionary mapping an endpoint to records
+    :rtype: dict
+    """
+    study_dir = os.path.join(snapshot_dir, kf_study_id)
+    if not os.path.isdir(study_dir):
+        raise FileNotFoundError(f"No snapshot of {kf_study_id} in {snapshot_dir}")
+
+    return {
+        filename[: -len(PARQUET_SUFFIX)]: pd.read_parquet(
+            os.path.join(study_dir, filename)
+        )
+        for filename in sorted(os.listdir(study_dir))
+        if filename.endswith(PARQUET_SUFFIX)
+    }
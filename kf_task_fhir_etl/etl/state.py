@@ -0,0 +1,56 @@
+"""
+Per-study ingest state kept in a SQLite DB between runs, e.g. the high-water
+mark of the last successful load of a study, from which the next incremental
+extraction starts.
+"""
+import sqlite3
+import threading
+
+
+class IngestState:
+    """A persistent SQLite store of values keyed by KF study ID and name."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._con:
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS study_state ("
+                "kf_study_id TEXT, name TEXT, value TEXT, "
+                "PRIMARY KEY (kf_study_id, name))"
+            )
+
+    def get(self, kf_study_id, name):
+        """Reads a study's value.
+
+        :param kf_study_id: A KF study ID
+        :type kf_study_id: str
+        :param name: A value's name (e.g. "watermark")
+        :type name: str
+        :return: The value, or None if it was never set
+        :rtype: str
+        """
+        with self._lock:
+            row = self._con.execute(
+                "SELECT value FROM study_state WHERE kf_study_id = ? AND name = ?",
+                (kf_study_id, name),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, kf_study_id, name, value):
+        """Writes a study's value.
+
+        :param kf_study_id: A KF study ID
+        :type kf_study_id: str
+        :param name: A value's name (e.g. "watermark")
+        :type name: str
+        :param value: The value
+        :type value: str
+        """
+        with self._lock, self._con:
+            self._con.execute(
+                "INSERT OR REPLACE INTO study_state (kf_study_id, name, value) "
+                "VALUES (?, ?, ?)",
+                (kf_study_id, name, value),
+            )
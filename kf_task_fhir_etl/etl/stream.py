@@ -0,0 +1,253 @@
+"""
+Streams a study's records into the FHIR service across all target classes at
+once, releasing each record as soon as the records that it references have
+FHIR IDs, rather than once every record of the referenced classes is loaded.
+
+Every record is tried as soon as a worker is free. When its builder asks for
+the FHIR ID of a record of another class that is still being loaded, the
+record is parked until that record is submitted, or until its whole class is
+done, and then tried again. References to records that aren't being loaded
+fall back to query_target_ids.
+
+With the asyncio client enabled (--async-submit), workers only build entities
+and hand their submissions to the client's event loop as coroutines, so the
+number of submissions in flight is bounded by the client's caps rather than
+by the number of workers. A record is finished, and the records parked on it
+released, once its submission completes.
+"""
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from kf_lib_data_ingest.config import DEFAULT_KEY
+from kf_task_fhir_etl.common.aio import get_async_client
+from kf_task_fhir_etl.common.bundle import get_bundle_submitter
+
+
+class NotReady(Exception):
+    """Raised when a referenced record of a class being loaded has no ID yet."""
+
+    def __init__(self, entity_class, key):
+        super().__init__(f"{entity_class.class_name} {key} isn't loaded yet")
+        self.entity_class = entity_class
+        self.key = key
+
+
+def _key(key_components):
+    return json.dumps(key_components, sort_keys=True, default=str)
+
+
+def get_records(entity_class, df_dict):
+    """Reads a target class's records like LoadStage does.
+
+    :param entity_class: A target entity class
+    :type entity_class: class
+    :param df_dict: A dictionary mapping a target class name to records
+    :type df_dict: dict
+    :return: A list of records
+    :rtype: list
+    """
+    df = df_dict.get(entity_class.class_name, df_dict.get(DEFAULT_KEY))
+    if df is None:
+        return []
+    records = df.astype(object).where(pd.notnull(df), None).to_dict(orient="records")
+    if hasattr(entity_class, "transform_records_list"):
+        records = entity_class.transform_records_list(records)
+    return records
+
+
+class _Parked:
+    """A record waiting for a referenced record or class to be loaded."""
+
+    def __init__(self, entity_class, record):
+        self.entity_class = entity_class
+        self.record = record
+        self.released = False
+
+
+class StreamingLoader:
+    """Loads records of many target classes with per-record dependencies."""
+
+    def __init__(self, host, target_classes, workers=32):
+        self.host = host
+        self.target_classes = list(target_classes)
+        self.workers = workers
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._tpex = None
+        self._target_ids = {}
+        self._parked = {}
+        self._outstanding = {}
+        self._seen = {}
+        self._failures = []
+        self._async = (
+            get_async_client() is not None and get_bundle_submitter(host) is None
+        )
+
+    def _get_target_id(self, entity_class, record, loading_class):
+        """Returns a record's FHIR ID, like LoadStage's get_target_id_from_record.
+
+        :raises NotReady: If the record's class is still being loaded, unless
+            it is the class of the record being built
+        """
+        key_components = entity_class.get_key_components(
+            record, lambda cls, rec: self._get_target_id(cls, rec, loading_class)
+        )
+        key = _key(key_components)
+
+        with self._lock:
+            target_id = self._target_ids.get((entity_class, key))
+            if (
+                target_id is None
+                and entity_class is not loading_class
+                and self._outstanding.get(entity_class)
+            ):
+                raise NotReady(entity_class, key)
+        if target_id is not None:
+            return target_id
+
+        target_ids = entity_class.query_target_ids(self.host, key_components)
+        if not target_ids:
+            return None
+        if len(target_ids) > 1:
+            raise Exception(
+                f"Found {len(target_ids)} {entity_class.class_name} resources "
+                f"for {key_components}: {target_ids}"
+            )
+        return target_ids[0]
+
+    def _park(self, entity_class, record, e):
+        """Parks a record on the record and the class that it waits for, or
+        retries it right away if they were loaded in the meantime.
+        """
+        with self._lock:
+            ready = (e.entity_class, e.key) in self._target_ids or not (
+                self._outstanding.get(e.entity_class)
+            )
+            if not ready:
+                parked = _Parked(entity_class, record)
+                self._parked.setdefault((e.entity_class, e.key), []).append(parked)
+                self._parked.setdefault((e.entity_class, None), []).append(parked)
+        if ready and not self._failures:
+            self._tpex.submit(self._load, entity_class, record)
+
+    def _load(self, entity_class, record):
+        if self._failures:
+            return
+
+        def get_target_id(cls, rec):
+            return self._get_target_id(cls, rec, entity_class)
+
+        key = None
+        try:
+            try:
+                key = _key(entity_class.get_key_components(record, get_target_id))
+            except NotReady:
+                raise
+            except Exception as e:
+                logging.debug(f"Skipping a {entity_class.class_name} record: {e}")
+                return self._finish(entity_class, None, None, "skipped")
+
+            with self._lock:
+                seen = self._seen.setdefault(entity_class, set())
+                if key in seen:
+                    duplicate = True
+                else:
+                    duplicate = False
+                    seen.add(key)
+            if duplicate:
+                return self._finish(entity_class, None, None, "duplicates")
+
+            entity = entity_class.build_entity(record, get_target_id)
+            if self._async:
+                future = entity_class.submit_async(self.host, entity)
+                future.add_done_callback(
+                    lambda f: self._submitted(entity_class, key, f)
+                )
+                return
+            target_id = entity_class.submit(self.host, entity)
+        except NotReady as e:
+            if key is not None:
+                with self._lock:
+                    self._seen[entity_class].discard(key)
+            return self._park(entity_class, record, e)
+        except Exception as e:
+            logging.exception(f"    ❌ Failed to load a {entity_class.class_name}")
+            with self._lock:
+                self._failures.append(e)
+            self._done.set()
+            return
+
+        return self._finish(entity_class, key, target_id, "loaded")
+
+    def _submitted(self, entity_class, key, future):
+        """Finishes a record once its asynchronous submission completes."""
+        try:
+            target_id = future.result()
+        except Exception as e:
+            logging.error(f"    ❌ Failed to load a {entity_class.class_name}: {e}")
+            with self._lock:
+                self._failures.append(e)
+            self._done.set()
+            return
+        self._finish(entity_class, key, target_id, "loaded")
+
+    def _finish(self, entity_class, key, target_id, outcome):
+        """Records a record's outcome and releases the records parked on it."""
+        released = []
+        with self._lock:
+            counts = self.stats.setdefault(
+                entity_class.class_name, {"loaded": 0, "duplicates": 0, "skipped": 0}
+            )
+            counts[outcome] += 1
+            if target_id is not None:
+                self._target_ids[(entity_class, key)] = target_id
+                released.extend(self._parked.pop((entity_class, key), []))
+            self._outstanding[entity_class] -= 1
+            if not self._outstanding[entity_class]:
+                released.extend(self._parked.pop((entity_class, None), []))
+                logging.info(f"    ✅ Loaded {entity_class.class_name}: {counts}")
+            if not any(self._outstanding.values()):
+                self._done.set()
+            released = [parked for parked in released if not parked.released]
+            for parked in released:
+                parked.released = True
+
+        for parked in released:
+            if not self._failures:
+                self._tpex.submit(self._load, parked.entity_class, parked.record)
+
+    def run(self, df_dict):
+        """Loads a study's records of all target classes.
+
+        :param df_dict: A dictionary mapping a target class name to records
+        :type df_dict: dict
+        :raises Exception: If any record fails to be loaded
+        :return: Loaded, duplicate, and skipped counts per class name
+        :rtype: dict
+        """
+        records = {
+            entity_class: get_records(entity_class, df_dict)
+            for entity_class in self.target_classes
+        }
+        for entity_class, class_records in records.items():
+            self._outstanding[entity_class] = len(class_records)
+        if not any(self._outstanding.values()):
+            self._done.set()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as tpex:
+            self._tpex = tpex
+            for entity_class, class_records in records.items():
+                for record in class_records:
+                    tpex.submit(self._load, entity_class, record)
+            self._done.wait()
+
+        if self._failures:
+            raise Exception(
+                f"Failed to load {len(self._failures)} records: {self._failures[0]}"
+            )
+        return self.stats
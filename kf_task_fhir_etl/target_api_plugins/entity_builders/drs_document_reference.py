@@ -7,13 +7,12 @@ from abc import abstractmethod
 
 import pandas as pd
 
-from requests import RequestException
-
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from kf_task_fhir_etl.target_api_plugins.entity_builders import Patient, Specimen
-from kf_task_fhir_etl.common.utils import not_none, drop_none, yield_resource_ids
-from d3b_utils.requests_retry import Session
+from kf_task_fhir_etl.common.utils import not_none
+from kf_task_fhir_etl.common.lookup import lookup_target_ids
+from kf_task_fhir_etl.common.dataservice import genomic_file_store
 
 KF_API_DATASERVICE_URL = (
     os.getenv("KF_API_DATASERVICE_URL")
@@ -203,6 +202,15 @@ class DRSDocumentReference:
 
             transfromed_records_list.append(transfromed_record)
 
+        # Prefetch Indexd metadata
+        genomic_file_store.prefetch(
+            KF_API_DATASERVICE_URL,
+            [
+                record[CONCEPT.GENOMIC_FILE.TARGET_SERVICE_ID]
+                for record in transfromed_records_list
+            ],
+        )
+
         return transfromed_records_list
 
     @classmethod
@@ -211,7 +219,7 @@ class DRSDocumentReference:
 
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return lookup_target_ids(cls, host, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
@@ -222,15 +230,7 @@ class DRSDocumentReference:
         biospecimen_id_list = record[CONCEPT.BIOSPECIMEN.TARGET_SERVICE_ID]
 
         # GET Indexd metadata
-        base_url = KF_API_DATASERVICE_URL.rstrip("/")
-        url = f"{base_url}/genomic-files/{genomic_file_id}"
-        resp = Session().get(url, headers={"Content-Type": "application/json"})
-        try:
-            resp.raise_for_status()
-        except:
-            raise RequestException(f"{resp.text}")
-
-        genomic_file = resp.json().get("results")
+        genomic_file = genomic_file_store.get(KF_API_DATASERVICE_URL, genomic_file_id)
 
         controlled_access = genomic_file.get("controlled_access")
         data_type = genomic_file.get("data_type")
@@ -5,7 +5,8 @@ from rows of tabular investigator metadata.
 from abc import abstractmethod
 
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from kf_task_fhir_etl.common.utils import not_none, drop_none, yield_resource_ids
+from kf_task_fhir_etl.common.utils import not_none
+from kf_task_fhir_etl.common.lookup import lookup_target_ids
 
 
 class Practitioner:
@@ -20,7 +21,7 @@ class Practitioner:
 
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return lookup_target_ids(cls, host, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
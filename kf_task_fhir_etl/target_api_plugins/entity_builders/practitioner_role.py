@@ -9,7 +9,8 @@ from kf_task_fhir_etl.target_api_plugins.entity_builders import (
     Practitioner,
     Organization,
 )
-from kf_task_fhir_etl.common.utils import not_none, drop_none, yield_resource_ids
+from kf_task_fhir_etl.common.utils import not_none
+from kf_task_fhir_etl.common.lookup import lookup_target_ids
 
 
 class PractitionerRole:
@@ -29,7 +30,7 @@ class PractitionerRole:
 
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return lookup_target_ids(cls, host, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
@@ -9,7 +9,8 @@ from kf_task_fhir_etl.target_api_plugins.entity_builders import (
     ResearchStudy,
     Patient,
 )
-from kf_task_fhir_etl.common.utils import not_none, drop_none, yield_resource_ids
+from kf_task_fhir_etl.common.utils import not_none
+from kf_task_fhir_etl.common.lookup import lookup_target_ids
 
 # http://hl7.org/fhir/ValueSet/research-subject-status
 status_code = "off-study"
@@ -32,7 +33,7 @@ class ResearchSubject:
 
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return lookup_target_ids(cls, host, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
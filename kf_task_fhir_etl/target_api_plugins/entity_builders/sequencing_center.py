@@ -4,22 +4,30 @@ from rows of tabular sequencing center data.
 """
 import inspect
 from abc import abstractmethod
+from functools import lru_cache
 
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from kf_task_fhir_etl.common.utils import not_none, drop_none, yield_resource_ids
+from kf_task_fhir_etl.common.utils import not_none
+from kf_task_fhir_etl.common.lookup import lookup_target_ids
 
-# Build a dictionary mapping KF IDs to sequencing center names
-module = constants.SEQUENCING.CENTER
-sequencing_center_name = {}
-for name, cls in inspect.getmembers(module):
-    if inspect.isclass(cls):
-        try:
-            kf_id = getattr(cls, "KF_ID")
-            name = getattr(cls, "NAME")
-            sequencing_center_name[kf_id] = name
-        except AttributeError:
-            pass
+
+@lru_cache(maxsize=None)
+def get_sequencing_center_names():
+    """Builds a dictionary mapping KF IDs to sequencing center names on first
+    use, rather than when the plugin is imported.
+    """
+    module = constants.SEQUENCING.CENTER
+    sequencing_center_name = {}
+    for name, cls in inspect.getmembers(module):
+        if inspect.isclass(cls):
+            try:
+                kf_id = getattr(cls, "KF_ID")
+                name = getattr(cls, "NAME")
+                sequencing_center_name[kf_id] = name
+            except AttributeError:
+                pass
+    return sequencing_center_name
 
 
 class SequencingCenter:
@@ -36,12 +44,12 @@ class SequencingCenter:
 
     @classmethod
     def query_target_ids(cls, host, key_components):
-        return list(yield_resource_ids(host, cls.api_path, drop_none(key_components)))
+        return lookup_target_ids(cls, host, key_components)
 
     @classmethod
     def build_entity(cls, record, get_target_id_from_record):
         sequencing_center_id = record[CONCEPT.SEQUENCING.CENTER.TARGET_SERVICE_ID]
-        name = sequencing_center_name.get(sequencing_center_id)
+        name = get_sequencing_center_names().get(sequencing_center_id)
 
         entity = {
             "resourceType": cls.api_path,
@@ -1,9 +1,24 @@
-import os
+import asyncio
+import concurrent.futures
 
-from dotenv import find_dotenv, load_dotenv
 from requests import RequestException
-from d3b_utils.requests_retry import Session
 
+from kf_task_fhir_etl.common.aio import get_async_client
+from kf_task_fhir_etl.common.bundle import get_bundle_submitter
+from kf_task_fhir_etl.common.concurrency import (
+    call,
+    call_async,
+    get_fhir_session,
+    get_limiter,
+)
+from kf_task_fhir_etl.common.ids import deterministic_ids_enabled
+from kf_task_fhir_etl.common.ledger import (
+    KeyedEntity,
+    entity_hash,
+    get_entity_ledger,
+)
+from kf_task_fhir_etl.common.lookup import target_id_index
+from kf_task_fhir_etl.config import FHIR_COOKIE, FHIR_USERNAME, FHIR_PASSWORD
 from kf_task_fhir_etl.target_api_plugins.entity_builders import (
     Practitioner,
     Organization,
@@ -25,34 +40,74 @@ from kf_task_fhir_etl.target_api_plugins.entity_builders import (
 
 LOADER_VERSION = 2
 
-DOTENV_PATH = find_dotenv()
-if DOTENV_PATH:
-    load_dotenv(DOTENV_PATH)
 
-FHIR_COOKIE = os.getenv("FHIR_COOKIE")
-FHIR_USERNAME = os.getenv("FHIR_USERNAME")
-FHIR_PASSWORD = os.getenv("FHIR_PASSWORD")
+def _url(*parts):
+    return "/".join([v.strip("/") for v in parts])
 
 
 def _PUT(host, api_path, resource_id, body, headers, auth=None):
-    return Session().put(
-        "/".join([v.strip("/") for v in [host, api_path, resource_id]]),
-        json=body,
-        headers=headers,
-        auth=auth,
+    url = _url(host, api_path, resource_id)
+    async_client = get_async_client()
+    if async_client is not None:
+        return call(
+            lambda: async_client.request(
+                "PUT",
+                url,
+                api_path,
+                headers=headers,
+                auth=auth,
+                json=body,
+                retry_statuses=get_limiter() is None,
+            )
+        )
+    return call(
+        lambda: get_fhir_session().put(url, json=body, headers=headers, auth=auth)
     )
 
 
 def _POST(host, api_path, body, headers, auth=None):
-    return Session().post(
-        "/".join([v.strip("/") for v in [host, api_path]]),
-        json=body,
-        headers=headers,
-        auth=auth,
+    url = _url(host, api_path)
+    async_client = get_async_client()
+    if async_client is not None:
+        return call(
+            lambda: async_client.request(
+                "POST",
+                url,
+                api_path,
+                headers=headers,
+                auth=auth,
+                json=body,
+                retry_statuses=get_limiter() is None,
+            )
+        )
+    return call(
+        lambda: get_fhir_session().post(url, json=body, headers=headers, auth=auth)
     )
 
 
-def submit(entity_class, host, body):
+def _diagnostics(resp):
+    try:
+        return resp.json().get("issue", [{}])[0].get("diagnostics", "")
+    except ValueError:
+        return ""
+
+
+def _headers():
+    headers = {
+        "Content-Type": "application/fhir+json;charset=utf-8",
+        "Cookie": FHIR_COOKIE,
+    }
+    return headers, (FHIR_USERNAME, FHIR_PASSWORD)
+
+
+def _submitted_id(api_path, body, resp):
+    if resp.status_code in {200, 201}:
+        return resp.json()["id"]
+    else:
+        raise RequestException(f"Sent to /{api_path}:\n{body}\nGot:\n{resp.text}")
+
+
+def _submit(entity_class, host, body):
     """Negotiates submitting the data for an entity to the target service.
 
     :param entity_class: Which entity class is being sent
@@ -65,33 +120,178 @@ def submit(entity_class, host, body):
     :return: The target entity ID that the service says was created or updated
     :rtype: str
     """
-    headers = {
-        "Content-Type": "application/fhir+json;charset=utf-8",
-        "Cookie": FHIR_COOKIE,
-    }
-    auth = (FHIR_USERNAME, FHIR_PASSWORD)
+    headers, auth = _headers()
 
     resp = None
     api_path = entity_class.api_path
     resource_id = body.get("id")
 
-    if resource_id:
+    bundle_submitter = get_bundle_submitter(host)
+    if bundle_submitter is not None:
+        return bundle_submitter.submit(api_path, body)
+
+    if deterministic_ids_enabled():
+        # Update-as-create: one idempotent PUT, no fallback
+        resp = _PUT(host, api_path, resource_id, body, headers=headers, auth=auth)
+    elif resource_id:
         resp = _PUT(host, api_path, resource_id, body, headers=headers, auth=auth)
         if (resp.status_code not in {200, 201}) and (
-            "no resource with this ID exists"
-            in resp.get("issue", [{}])[0].get("diagnostics", "")
+            "no resource with this ID exists" in _diagnostics(resp)
         ):
             resp = None
     else:
         body.pop("id", None)
 
-    if not resp:
+    if resp is None:
         resp = _POST(host, api_path, body, headers=headers, auth=auth)
 
-    if resp.status_code in {200, 201}:
-        return resp.json()["id"]
+    return _submitted_id(api_path, body, resp)
+
+
+async def _submit_async(client, entity_class, host, body):
+    """Negotiates submitting an entity like _submit, as a coroutine on the
+    asyncio client's loop, under the adaptive concurrency limit if enabled.
+    """
+    headers, auth = _headers()
+
+    resp = None
+    api_path = entity_class.api_path
+    resource_id = body.get("id")
+    retry_statuses = get_limiter() is None
+
+    def send(method, url):
+        return call_async(
+            lambda: client.send(
+                method,
+                url,
+                api_path,
+                headers=headers,
+                auth=auth,
+                json=body,
+                retry_statuses=retry_statuses,
+            )
+        )
+
+    if deterministic_ids_enabled():
+        # Update-as-create: one idempotent PUT, no fallback
+        resp = await send("PUT", _url(host, api_path, resource_id))
+    elif resource_id:
+        resp = await send("PUT", _url(host, api_path, resource_id))
+        if (resp.status_code not in {200, 201}) and (
+            "no resource with this ID exists" in _diagnostics(resp)
+        ):
+            resp = None
     else:
-        raise RequestException(f"Sent to /{api_path}:\n{body}\nGot:\n{resp.text}")
+        body.pop("id", None)
+
+    if resp is None:
+        resp = await send("POST", _url(host, api_path))
+
+    return _submitted_id(api_path, body, resp)
+
+
+def _index(entity_class, host, body, target_id):
+    for identifier in body.get("identifier", []):
+        value = identifier.get("value")
+        if isinstance(value, str):
+            target_id_index.add(host, entity_class.api_path, value, target_id)
+
+
+def submit(entity_class, host, body):
+    """Submits an entity unless the entity ledger has it with identical content,
+    and indexes its FHIR ID by identifier for the classes that reference it.
+
+    :param entity_class: Which entity class is being sent
+    :type entity_class: class
+    :param host: A host url
+    :type host: str
+    :param body: Map between entity keys and values
+    :type body: dict
+    :raise: RequestException on error
+    :return: The target entity ID that the service says was created or updated
+    :rtype: str
+    """
+    ledger = get_entity_ledger()
+    target_id = ledger.get(host, entity_class, body) if ledger is not None else None
+
+    if not target_id:
+        digest = entity_hash(body) if ledger is not None else None
+        target_id = _submit(entity_class, host, body)
+        if ledger is not None:
+            ledger.put(host, entity_class, body, digest, target_id)
+
+    _index(entity_class, host, body, target_id)
+    return target_id
+
+
+def submit_async(entity_class, host, body):
+    """Submits an entity like submit, but as a coroutine on the asyncio client
+    so that the calling thread doesn't wait for the FHIR service.
+
+    :param entity_class: Which entity class is being sent
+    :type entity_class: class
+    :param host: A host url
+    :type host: str
+    :param body: Map between entity keys and values
+    :type body: dict
+    :raise: RuntimeError if the asyncio client isn't enabled
+    :return: A future of the target entity ID that the service says was
+        created or updated, which raises RequestException on error
+    :rtype: concurrent.futures.Future
+    """
+    client = get_async_client()
+    if client is None:
+        raise RuntimeError("Asynchronous submits require --async-submit")
+
+    ledger = get_entity_ledger()
+    target_id = ledger.get(host, entity_class, body) if ledger is not None else None
+    if target_id:
+        _index(entity_class, host, body, target_id)
+        future = concurrent.futures.Future()
+        future.set_result(target_id)
+        return future
+
+    digest = entity_hash(body) if ledger is not None else None
+
+    async def run():
+        target_id = await _submit_async(client, entity_class, host, body)
+        if ledger is not None:
+            # SQLite writes would block the event loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, ledger.put, host, entity_class, body, digest, target_id
+            )
+        _index(entity_class, host, body, target_id)
+        return target_id
+
+    return client.run(run())
+
+
+def keep_key_components(entity_class):
+    """Wraps a builder's build_entity so that, with the entity ledger enabled,
+    its entities carry the key components that the ledger keys them by.
+
+    LoadStage executes this module again for every load, so a class whose
+    build_entity is already wrapped is left as it is.
+
+    :param entity_class: A target entity class
+    :type entity_class: class
+    """
+    build_entity = entity_class.build_entity
+    if getattr(build_entity, "_keyed", False):
+        return
+
+    def keyed_build_entity(record, get_target_id_from_record):
+        entity = build_entity(record, get_target_id_from_record)
+        if get_entity_ledger() is None:
+            return entity
+        entity = KeyedEntity(entity)
+        entity.key_components = entity_class.get_key_components(
+            record, get_target_id_from_record
+        )
+        return entity
+
+    keyed_build_entity._keyed = True
+    entity_class.build_entity = staticmethod(keyed_build_entity)
 
 
 # Override submitter
@@ -111,6 +311,22 @@ SequencingCenter.submit = classmethod(submit)
 Specimen.submit = classmethod(submit)
 Histopathology.submit = classmethod(submit)
 DRSDocumentReference.submit = classmethod(submit)
+Practitioner.submit_async = classmethod(submit_async)
+Organization.submit_async = classmethod(submit_async)
+PractitionerRole.submit_async = classmethod(submit_async)
+Patient.submit_async = classmethod(submit_async)
+ProbandStatus.submit_async = classmethod(submit_async)
+FamilyRelationship.submit_async = classmethod(submit_async)
+Family.submit_async = classmethod(submit_async)
+ResearchStudy.submit_async = classmethod(submit_async)
+ResearchSubject.submit_async = classmethod(submit_async)
+Disease.submit_async = classmethod(submit_async)
+Phenotype.submit_async = classmethod(submit_async)
+VitalStatus.submit_async = classmethod(submit_async)
+SequencingCenter.submit_async = classmethod(submit_async)
+Specimen.submit_async = classmethod(submit_async)
+Histopathology.submit_async = classmethod(submit_async)
+DRSDocumentReference.submit_async = classmethod(submit_async)
 
 all_targets = [
     Practitioner,
@@ -130,3 +346,6 @@ all_targets = [
     Histopathology,
     DRSDocumentReference,
 ]
+
+for target in all_targets:
+    keep_key_components(target)